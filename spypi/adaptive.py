@@ -0,0 +1,113 @@
+import logging
+import time
+
+
+class AdaptiveController():
+    """
+    Decides how much of the web stream is worth sending. With a motion detector, frames go out at
+    'motion_rate' while there has been motion in the last 'motion_hold' seconds and at
+    'keepalive_rate' otherwise. Without one the rate stays at 'base_rate'. When the average image
+    POST latency rises above 'latency_target', JPEG quality is lowered in steps down to
+    'min_quality', then the output resolution down to 'min_scale'. Both recover once latency falls
+    below half the target. Changes are made at most once per 'interval' seconds.
+    """
+
+    SCALE_STEP = 0.75
+    # Frames arrive with some jitter - don't skip one for being slightly early
+    SLACK = 0.9
+
+    def __init__(self, connector, transform, motion=None, base_rate=3, motion_rate=6, keepalive_rate=0.2,
+                 motion_hold=5, latency_target=0.5, min_quality=50, quality_step=10, min_scale=0.5,
+                 interval=2, log_metrics=False):
+        self.logger = logging.getLogger("adaptive")
+        self.connector = connector
+        self.transform = transform
+        self.motion = motion
+        self.base_rate = base_rate
+        self.motion_rate = motion_rate
+        self.keepalive_rate = keepalive_rate
+        self.motion_hold = motion_hold
+        self.latency_target = latency_target
+        self.max_quality = connector.encoder.quality
+        self.min_quality = min(min_quality, self.max_quality)
+        self.quality_step = quality_step
+        self.min_scale = min_scale
+        self.interval = interval
+        self.log_metrics = log_metrics
+        self.rate = base_rate
+        self.quality = self.max_quality
+        self.scale = 1.0
+        self.reason = "start"
+        self.last_sent = 0
+        self.last_adjusted = 0
+        self.sent = 0
+        self.skipped = 0
+        self.listeners = []
+
+    def get_rate(self, now):
+        if self.motion is None:
+            return self.base_rate
+        if now - self.motion.last_motion < self.motion_hold:
+            return self.motion_rate
+        return self.keepalive_rate
+
+    def adjust_quality(self, latency):
+        if latency > self.latency_target:
+            if self.quality > self.min_quality:
+                self.quality = max(self.min_quality, self.quality - self.quality_step)
+                return "congested"
+            if self.scale > self.min_scale:
+                self.scale = max(self.min_scale, round(self.scale * self.SCALE_STEP, 3))
+                return "congested"
+        elif latency < self.latency_target / 2:
+            # Resolution comes back before quality, the reverse of how they were given up
+            if self.scale < 1:
+                self.scale = min(1.0, round(self.scale / self.SCALE_STEP, 3))
+                return "recovered"
+            if self.quality < self.max_quality:
+                self.quality = min(self.max_quality, self.quality + self.quality_step)
+                return "recovered"
+        return None
+
+    def update(self, now):
+        rate = self.get_rate(now)
+        reason = None
+        if rate != self.rate:
+            reason = "motion" if rate > self.rate else "static"
+            self.rate = rate
+        if now - self.last_adjusted >= self.interval:
+            self.last_adjusted = now
+            reason = self.adjust_quality(self.connector.get_latency('image')) or reason
+        if reason:
+            self.reason = reason
+            self.connector.encoder.quality = self.quality
+            self.transform.set_output_scale(self.scale)
+            if self.log_metrics:
+                self.logger.debug("Adaptive // {0} // rate: {1} fps // quality: {2} // scale: {3} // "
+                                  "latency: {4} ms".format(reason, self.rate, self.quality, self.scale,
+                                                           round(1000 * self.connector.get_latency('image'), 1)))
+            for listener in self.listeners:
+                listener(self.get_state())
+
+    def should_send(self):
+        """
+        Called by the web stream before a frame is transformed - False skips the frame
+        """
+        now = time.monotonic()
+        self.update(now)
+        if now - self.last_sent < self.SLACK / self.rate:
+            self.skipped += 1
+            return False
+        self.last_sent = now
+        self.sent += 1
+        return True
+
+    def get_state(self):
+        return {
+            'rate': self.rate,
+            'quality': self.quality,
+            'scale': self.scale,
+            'reason': self.reason,
+            'sent': self.sent,
+            'skipped': self.skipped,
+        }
@@ -1,5 +1,6 @@
 import faulthandler
 import importlib
+import json
 import logging.config
 import os
 import shutil
@@ -11,6 +12,8 @@ import click
 import subprocess
 from click_default_group import DefaultGroup
 
+from spypi import metrics
+from spypi import trace
 from spypi.config import load_config, ConfigValidationError
 from spypi.resources import get_resource
 from spypi.utils import get_environment, init_logger, is_windows
@@ -21,9 +24,8 @@ if not is_windows():
     sys.path.insert(0, '/usr/lib/python37.zip')
     sys.path.insert(0, '/usr/local/lib/python3.7/dist-packages')
     try:
+        # Camera SDKs (ArducamSDK, picamera) are checked by the camera that needs them
         importlib.import_module('cv2')
-        importlib.import_module('ArducamSDK')
-        importlib.import_module('picamera')
     except ImportError as e:
         click.echo("Unable to import {} - have you run the install script?".format(e))
         click.echo("Find it here: https://github.com/vossenv/spypi")
@@ -31,7 +33,9 @@ if not is_windows():
 else:
     sys.path.insert(0, os.path.abspath('./lib'))
 
+from spypi.bench import SUITES, run_benchmarks, print_results
 from spypi.process import ImageProcessor, ImagePlayer, ImageWriter
+from spypi.supervisor import Supervisor
 
 logger = init_logger({})
 
@@ -110,9 +114,10 @@ def install(ctx):
 @click.pass_context
 @click.option('-c', '--config-filename', default='config.yaml', type=str)
 @click.option('-n', '--number', default=1, type=int)
-def single_image(ctx, config_filename, number):
+@click.option('--raw', is_flag=True, default=False, help="Dump unconverted arducam frames for the replay camera")
+def single_image(ctx, config_filename, number, raw):
     cfg = init_config(ctx.params, config_filename)
-    ImageWriter(cfg).write_images(number)
+    ImageWriter(cfg).write_images(number, raw)
 
 
 @cli.command(help="Display the feed (requires display)")
@@ -120,7 +125,43 @@ def single_image(ctx, config_filename, number):
 @click.option('-c', '--config-filename', default='config.yaml', type=str)
 def run(ctx, config_filename):
     cfg = init_config(ctx.params, config_filename)
-    ImageProcessor(cfg).run()
+    if cfg.get('devices'):
+        Supervisor(cfg).run()
+    else:
+        ImageProcessor(cfg).run()
+    # Not before - in multiprocess mode run() forks, and the server's thread must not be running then
+    if cfg['metrics']['enabled']:
+        metrics.serve(cfg['metrics']['port'])
+
+
+@cli.command(help="Summarize per-stage frame latency from trace files")
+@click.argument('filenames', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--camera', default=None, type=str, help="Only frames from this camera")
+@click.option('--stream', default=None, type=click.Choice(['web', 'video']), help="Only frames from this stream")
+def trace_report(filenames, camera, stream):
+    traces = [t for t in trace.load_traces(filenames)
+              if (camera is None or t['camera'] == camera) and (stream is None or t['stream'] == stream)]
+    if not traces:
+        click.echo("No traces found")
+        return
+    click.echo(trace.format_report(trace.summarize(traces)))
+
+
+@cli.command(help="Benchmark the hot paths and the pipeline end to end")
+@click.option('-s', '--suite', multiple=True, type=click.Choice(SUITES), help="Only run this suite (repeatable)")
+@click.option('-o', '--output', default=None, type=click.Path(dir_okay=False, allow_dash=True),
+              help="Write the results as JSON, '-' for stdout")
+@click.option('--seconds', default=5, type=int, help="Length of each connector and end to end run")
+def bench(suite, output, seconds):
+    results = run_benchmarks(suite, seconds)
+    if output == '-':
+        click.echo(json.dumps(results, indent=2))
+        return
+    print_results(results['results'])
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        click.echo("Results written to {}".format(output))
 
 
 if __name__ == '__main__':
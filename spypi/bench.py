@@ -0,0 +1,402 @@
+import multiprocessing
+import os
+import platform
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+import cv2
+import numpy as np
+
+import spypi.lib.ImageConvert as ic
+from spypi._version import __version__
+from spypi.encoder import WRITERS
+from spypi.error import EncoderException
+from spypi.model import ImageManip as im, TransformPipeline, DataBar, Connector, JpegEncoder, VideoStream
+from spypi.motion import MotionDetector
+
+# Frame sizes of the default config - the web/processing size and the sensor's native size
+RESOLUTIONS = [(1300, 1000), (1280, 964)]
+
+CONVERT_CASES = [
+    # name, format mode, bit width, pixel bytes, color mode
+    ('RAW8', ic.FORMAT_MODE_RAW, 8, 1, 2),
+    ('RAW12', ic.FORMAT_MODE_RAW, 12, 2, 2),
+    ('RAW_D', ic.FORMAT_MODE_RAW_D, 8, 2, 2),
+    ('RGB565', ic.FORMAT_MODE_RGB, 8, 2, 2),
+    ('YUV', ic.FORMAT_MODE_YUV, 8, 2, 2),
+    ('JPG', ic.FORMAT_MODE_JPG, 8, 1, 2),
+    ('MON8', ic.FORMAT_MODE_MON, 8, 1, 2),
+    ('MON12', ic.FORMAT_MODE_MON, 12, 2, 2),
+    ('MON_D', ic.FORMAT_MODE_MON_D, 8, 2, 2),
+]
+
+
+def timeit(func, repeat=50, warmup=3):
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    times.sort()
+    return {
+        'mean_ms': round(1000 * sum(times) / len(times), 4),
+        'p50_ms': round(1000 * times[len(times) // 2], 4),
+        'min_ms': round(1000 * times[0], 4),
+    }
+
+
+def make_raw_frame(mode, bit_width, pixel_bytes, width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    cfg = {
+        "u32Width": width,
+        "u32Height": height,
+        "u8PixelBits": bit_width,
+        "u8PixelBytes": pixel_bytes,
+        "emImageFmtMode": mode,
+    }
+    if mode == ic.FORMAT_MODE_JPG:
+        image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        data = cv2.imencode('.jpg', cv2.GaussianBlur(image, (9, 9), 0))[1].tobytes()
+    elif pixel_bytes == 2 and bit_width > 8:
+        data = rng.integers(0, 2 ** bit_width, width * height, dtype=np.uint16).tobytes()
+    else:
+        data = rng.integers(0, 256, width * height * pixel_bytes, dtype=np.uint8).tobytes()
+    cfg["u32Size"] = len(data)
+    return data, cfg
+
+
+def bench_convert(width=1280, height=964, repeat=50):
+    results = {}
+    for name, mode, bit_width, pixel_bytes, color_mode in CONVERT_CASES:
+        data, cfg = make_raw_frame(mode, bit_width, pixel_bytes, width, height)
+        converter = ic.ImageConverter(cfg, color_mode)
+        results[name] = {
+            'legacy': timeit(lambda: ic.convert_image(data, cfg, color_mode), repeat),
+            'converter': timeit(lambda: converter.convert(data, cfg['u32Size']), repeat),
+        }
+    return results
+
+
+def bench_raw_lut(width=1280, height=964, bit_width=12, repeat=50):
+    data, cfg = make_raw_frame(ic.FORMAT_MODE_MON, bit_width, 2, width, height)
+    shift = ic.ImageConverter(cfg, None)
+    lut = ic.ImageConverter(cfg, None, ic.build_raw_lut(bit_width, gamma=2.2, black_level=16))
+    return {
+        'shift': timeit(lambda: shift.convert(data), repeat),
+        'lut': timeit(lambda: lut.convert(data), repeat),
+    }
+
+
+def make_image(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    return cv2.GaussianBlur(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), (9, 9), 0)
+
+
+def bench_manip(width=1300, height=1000, repeat=30):
+    image = make_image(width, height)
+    return {
+        'crop': timeit(lambda: im.crop(image, [10, 10, 10, 10]), repeat),
+        'resize': timeit(lambda: im.resize(image, [640, 480]), repeat),
+        'rotate_90': timeit(lambda: im.rotate(image, 90), repeat),
+        'rotate_30': timeit(lambda: im.rotate(image, 30), repeat),
+    }
+
+
+def bench_transforms(width=1300, height=1000, repeat=30):
+    image = make_image(width, height)
+    results = {}
+    for name, crop, size, rotation, keep_size in [
+        ('web', [10, 10, 10, 10], [640, 480], 90, False),
+        ('video', [0, 0, 0, 0], None, 30, True),
+    ]:
+        def legacy():
+            i = im.crop(image, crop)
+            i = im.resize(i, size)
+            return im.rotate(i, rotation, resize=keep_size)
+
+        pipeline = TransformPipeline(crop, size, rotation, keep_size)
+        results[name] = {
+            'legacy': timeit(legacy, repeat),
+            'pipeline': timeit(lambda: pipeline.release(pipeline(image)), repeat),
+        }
+    return results
+
+
+def bench_data_bar(width=1300, height=1000, repeat=200):
+    image = make_image(width, height)
+    bar = DataBar(0.8, 10)
+    labels = [["2020-12-01: 10:{0:02d}:{1:02d}:{2} @ {3:.2f} FPS".format(i // 600 % 60, i // 10 % 60, i % 10, 6 + i % 7 / 10),
+               "Time: 1234 ISO: 56 LUM:78/90"] for i in range(repeat + 3)]
+    counters = {'legacy': iter(labels), 'cached': iter(labels)}
+
+    def legacy():
+        label = next(counters['legacy'])
+        i = im.rectangle(image, [width, bar.get_height(len(label))])
+        return im.add_label(i, label, bar.text_height, bar.scale, (255, 255, 255), bar.padding)
+
+    # The whole of what a stream does per frame, timestamp and fps label included
+    from spypi.process import ImageProcessor
+    processor = ImageProcessor(get_config(width, height))
+
+    return {
+        'legacy': timeit(legacy, repeat),
+        'cached': timeit(lambda: bar.draw(image, next(counters['cached'])), repeat),
+        'apply_data_bar': timeit(lambda: processor.apply_data_bar(image, 6.0, 'web'), repeat),
+    }
+
+
+def bench_jpeg(width=1300, height=1000, repeat=30):
+    image = make_image(width, height)
+    results = {}
+    for backend in ['opencv', 'turbojpeg']:
+        results[backend] = {}
+        for quality in [95, 70]:
+            encoder = JpegEncoder(quality)
+            if backend == 'opencv':
+                encoder.turbo = None
+            elif encoder.turbo is None:
+                results[backend] = {'error': "libjpeg-turbo is not available"}
+                break
+            results[backend]['q{}'.format(quality)] = timeit(lambda: encoder.encode(image), repeat)
+    return results
+
+
+def bench_video(width=1280, height=964, frames=90):
+    """
+    add_frame is what the video stream pays per frame; the writer thread encodes behind it, so
+    frames_per_s - queueing every frame at once and waiting for the last to be written - is how
+    fast each backend can keep up
+    """
+    from spypi.config import CONFIG_DEFAULTS
+    image = make_image(2 * width, height)
+    images = [np.ascontiguousarray(image[:, i:i + width]) for i in range(0, width, width // 10)]
+    results = {}
+    for backend in WRITERS:
+        directory = tempfile.mkdtemp()
+        try:
+            stream = VideoStream(filename_prefix='bench', directory=directory, resolution=(width, height), fps=30,
+                                 queue_size=frames, encoder=dict(CONFIG_DEFAULTS['processing']['video_encoder'],
+                                                                 backend=backend))
+        except EncoderException as e:
+            results[backend] = {'error': str(e)}
+            shutil.rmtree(directory, ignore_errors=True)
+            continue
+        counter = iter(range(frames))
+        start = time.perf_counter()
+        add = timeit(lambda: stream.add_frame(images[next(counter) % len(images)]), frames, warmup=0)
+        stream.stop()
+        elapsed = time.perf_counter() - start
+        results[backend] = {
+            'add_frame': add,
+            'frames_per_s': round((frames - stream.queue.dropped) / elapsed, 2),
+            'dropped': stream.queue.dropped,
+        }
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def bench_motion(width=1300, height=1000, repeat=200):
+    rng = np.random.default_rng(0)
+    image = make_image(width, height)
+    frames = [cv2.add(image, rng.integers(0, 8, image.shape, dtype=np.uint8)) for _ in range(10)]
+    detector = MotionDetector()
+    counter = iter(range(repeat + 10))
+    return {
+        'detector': timeit(lambda: detector.update(frames[next(counter) % len(frames)]), repeat),
+    }
+
+
+class StubServer():
+    """
+    Local stand-in for the spypi server which accepts any post after an optional delay
+    """
+
+    def __init__(self, latency=0.0, port=0):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self.rfile.read(length)
+                time.sleep(stub.latency)
+                with stub.lock:
+                    stub.requests += 1
+                    stub.bytes += length
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.host = "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def get_connection_config(host, **kwargs):
+    from spypi.config import CONFIG_DEFAULTS
+    cfg = dict(CONFIG_DEFAULTS['connection'], host=host, name='bench')
+    cfg.update(kwargs)
+    return cfg
+
+
+def bench_connector(width=1300, height=1000, latency=0.2, seconds=5, rate=30):
+    image = make_image(width, height)
+    results = {}
+    for mode in ['sync', 'async']:
+        with StubServer(latency) as server:
+            try:
+                connector = Connector.create(get_connection_config(server.host, mode=mode, encode_queue=8))
+            except ImportError as e:
+                results[mode] = {'error': str(e)}
+                continue
+            end = time.perf_counter() + seconds
+            while time.perf_counter() < end:
+                connector.send_image(image)
+                time.sleep(1 / rate)
+            time.sleep(latency)
+            connector.stop()
+            results[mode] = {
+                'posts_per_s': round(server.requests / seconds, 2),
+                'mean_latency_ms': round(1000 * connector.get_latency('image'), 1),
+            }
+    return results
+
+
+def get_config(width, height, host="http://127.0.0.1", rate=30, **processing):
+    """
+    Default config with a synthetic camera posting as 'bench' to 'host'
+    """
+    from spypi.config import CONFIG_DEFAULTS, merge_dict
+    return merge_dict(CONFIG_DEFAULTS, {
+        'device': {'camera': 'synthetic', 'frame_size': [width, height], 'source_framerate': rate},
+        'connection': {'host': host, 'name': 'bench'},
+        'processing': dict({'target_web_framerate': rate, 'target_video_framerate': rate}, **processing),
+        'logging': {'log_metrics': False},
+    }, True)
+
+
+def run_pipeline(multiprocess, width, height, rate, seconds, results):
+    # Runs in a process of its own - the pipeline has no way to stop its threads and processes
+    from spypi.process import ImageProcessor
+    directory = tempfile.mkdtemp()
+    with StubServer() as server:
+        config = get_config(width, height, server.host, rate, multiprocess=multiprocess,
+                            recording_directory=directory, send_video=False)
+        processor = ImageProcessor(config)
+        processor.run()
+        time.sleep(2)
+        start = {name: value.value for name, value in processor.processed.items()}
+        requests = server.requests
+        time.sleep(seconds)
+        results.put({
+            'camera_fps': round(processor.camera.image_counter.get_rate(), 2),
+            'web_fps': round((processor.processed['web'].value - start['web']) / seconds, 2),
+            'posts_per_s': round((server.requests - requests) / seconds, 2),
+            'video_fps': round((processor.processed['video'].value - start['video']) / seconds, 2),
+        })
+    if multiprocess:
+        processor.stop_processes()
+    results.close()
+    results.join_thread()
+    shutil.rmtree(directory, ignore_errors=True)
+    os._exit(0)
+
+
+def bench_pipeline(width=1300, height=1000, rate=30, seconds=5):
+    """
+    End to end synthetic camera with web and video streams at 'rate', threaded against one
+    process per stage. Rates falling short of 'rate' show where the pipeline runs out of headroom.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for mode, multiprocess in [('threaded', False), ('multiprocess', True)]:
+        queue = context.Queue()
+        process = context.Process(target=run_pipeline, args=(multiprocess, width, height, rate, seconds, queue))
+        process.start()
+        results[mode] = queue.get(timeout=seconds + 60)
+        process.join()
+    return results
+
+
+def bench_pipelines(rate=30, seconds=5):
+    return OrderedDict(("{0}x{1}".format(width, height), bench_pipeline(width, height, rate, seconds))
+                       for width, height in RESOLUTIONS)
+
+
+SUITES = ['convert', 'raw_lut', 'manip', 'transforms', 'data_bar', 'jpeg', 'video', 'motion', 'connector',
+          'pipeline']
+
+
+def get_environment():
+    return {
+        'app_version': __version__,
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+        'time': datetime.now().isoformat(timespec='seconds'),
+    }
+
+
+def run_benchmarks(suites=None, seconds=5):
+    """
+    Runs the named suites (all of them by default) in a fixed order on fixed inputs
+    :param seconds: how long each connector and end to end run lasts
+    :return: {'environment': ..., 'results': {suite: ...}}
+    """
+    benchmarks = {
+        'convert': bench_convert,
+        'raw_lut': bench_raw_lut,
+        'manip': bench_manip,
+        'transforms': bench_transforms,
+        'data_bar': bench_data_bar,
+        'jpeg': bench_jpeg,
+        'video': bench_video,
+        'motion': bench_motion,
+        'connector': lambda: bench_connector(seconds=seconds),
+        'pipeline': lambda: bench_pipelines(seconds=seconds),
+    }
+    results = OrderedDict()
+    for name in SUITES:
+        if not suites or name in suites:
+            results[name] = benchmarks[name]()
+    return {'environment': get_environment(), 'results': results}
+
+
+def print_results(results, indent=0):
+    for name, value in results.items():
+        if isinstance(value, dict) and any(isinstance(v, dict) for v in value.values()):
+            click.echo("{0}{1}".format(' ' * indent, name))
+            print_results(value, indent + 2)
+        else:
+            click.echo("{0}{1:<16} {2}".format(' ' * indent, name, value))
+
+
+if __name__ == '__main__':
+    print_results(run_benchmarks()['results'])
@@ -0,0 +1,402 @@
+import logging
+import mmap
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+
+class Frame():
+
+    def __init__(self, buffer, generation, slot, seq, timestamp, image, captured=None):
+        self.buffer = buffer
+        self.generation = generation
+        self.slot = slot
+        self.seq = seq
+        # Committed to the buffer, and read from the sensor where the camera knows when that was
+        self.timestamp = timestamp
+        self.captured = timestamp if captured is None else captured
+        self.image = image
+
+    def release(self):
+        if self.buffer is not None:
+            self.buffer.release(self)
+            self.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class FrameBuffer():
+    """
+    Fixed set of preallocated frame slots shared between one producer and any number of readers.
+    Readers borrow a read-only view of a slot instead of copying it; the producer never
+    overwrites a borrowed slot, and drops the frame instead if every slot is in use.
+    Readers can block until a frame newer than the last one they saw is committed.
+    """
+
+    def __init__(self, size=5):
+        if size < 2:
+            raise ValueError("Frame buffer needs at least two slots")
+        self.size = size
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.slots = None
+        self.generation = 0
+        self.seq = 0
+        self.dropped = 0
+        self.reset()
+
+    def reset(self):
+        self.seqs = [-1] * self.size
+        self.times = [0.0] * self.size
+        self.captured = [0.0] * self.size
+        self.borrows = [0] * self.size
+        self.latest = None
+
+    def allocate(self, shape, dtype):
+        self.slots = np.empty((self.size,) + shape, dtype=dtype)
+        self.generation += 1
+        self.reset()
+
+    def clear(self):
+        # Borrowed slots stay borrowed - readers may still be holding them
+        with self.lock:
+            self.seqs = [-1] * self.size
+            self.latest = None
+
+    def __len__(self):
+        return sum(1 for s in self.seqs if s >= 0)
+
+    def put(self, image, captured=None):
+        with self.lock:
+            if self.slots is None or self.slots.shape[1:] != image.shape or self.slots.dtype != image.dtype:
+                self.allocate(image.shape, image.dtype)
+            slot = self.get_free_slot()
+            if slot is None:
+                self.dropped += 1
+                return None
+            # Hide the slot from readers while it is being written
+            self.seqs[slot] = -1
+            slots = self.slots
+
+        np.copyto(slots[slot], image)
+
+        with self.lock:
+            if slots is not self.slots:
+                # Reallocated mid-copy - frame no longer has a home
+                return None
+            self.seq += 1
+            self.seqs[slot] = self.seq
+            self.times[slot] = time.time()
+            self.captured[slot] = captured or self.times[slot]
+            self.latest = slot
+            self.ready.notify_all()
+            return self.seq
+
+    def get_free_slot(self):
+        free = None
+        for i in range(self.size):
+            if self.borrows[i] or i == self.latest:
+                continue
+            if free is None or self.seqs[i] < self.seqs[free]:
+                free = i
+        return free
+
+    def has_newer(self, after):
+        return self.latest is not None and self.seqs[self.latest] > after
+
+    def acquire(self, after=0, timeout=0):
+        """
+        Borrow the newest frame with a sequence number above 'after'
+        :param after: sequence number of the last frame seen by the caller
+        :param timeout: seconds to wait for such a frame - 0 returns immediately, None waits forever
+        :return: Frame, or None if no newer frame arrived in time
+        """
+        with self.lock:
+            if timeout != 0 and not self.ready.wait_for(lambda: self.has_newer(after), timeout):
+                return None
+            if not self.has_newer(after):
+                return None
+            slot = self.latest
+            self.borrows[slot] += 1
+            view = self.slots[slot].view()
+            view.flags.writeable = False
+            return Frame(self, self.generation, slot, self.seqs[slot], self.times[slot], view, self.captured[slot])
+
+    def release(self, frame):
+        with self.lock:
+            if frame.generation == self.generation and self.borrows[frame.slot] > 0:
+                self.borrows[frame.slot] -= 1
+
+    def reader(self):
+        return FrameReader(self)
+
+
+class FrameReader():
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.last_seq = 0
+
+    def next(self, timeout=0):
+        frame = self.buffer.acquire(after=self.last_seq, timeout=timeout)
+        if frame is not None:
+            self.last_seq = frame.seq
+        return frame
+
+
+class SharedSegment():
+    """
+    A SharedFrameBuffer's slot headers and frame data, in a file under /dev/shm that any process can
+    map by name. Works the same with or without multiprocessing.shared_memory (Python < 3.8).
+    """
+
+    HEADER = np.dtype([('seq', np.int64), ('timestamp', np.float64), ('captured', np.float64),
+                       ('shape', np.int32, 3)], align=True)
+    DIRECTORY = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+    def __init__(self, name, size, capacity=None):
+        """
+        :param capacity: bytes per slot to create the segment with - None maps an existing one
+        """
+        self.name = name
+        self.path = os.path.join(self.DIRECTORY, name)
+        header_size = size * self.HEADER.itemsize
+        if capacity is not None:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+            os.ftruncate(fd, header_size + size * capacity)
+        else:
+            fd = os.open(self.path, os.O_RDWR)
+            capacity = (os.fstat(fd).st_size - header_size) // size
+        try:
+            memory = mmap.mmap(fd, header_size + size * capacity)
+        finally:
+            os.close(fd)
+        self.capacity = capacity
+        self.header = np.ndarray((size,), dtype=self.HEADER, buffer=memory)
+        self.data = np.ndarray((size, capacity), dtype=np.uint8, buffer=memory, offset=header_size)
+
+    def unlink(self):
+        # Processes which have it mapped keep it until they let go
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def read(self, slot, seq):
+        """
+        :return: Frame holding a private copy of the slot, or None if it no longer holds frame 'seq'
+        """
+        if self.header['seq'][slot] != seq:
+            return None
+        timestamp = float(self.header['timestamp'][slot])
+        captured = float(self.header['captured'][slot])
+        shape = tuple(int(d) for d in self.header['shape'][slot] if d)
+        image = self.data[slot, :int(np.prod(shape))].reshape(shape).copy()
+        if self.header['seq'][slot] != seq:
+            return None
+        image.flags.writeable = False
+        return Frame(None, 0, slot, seq, timestamp, image, captured)
+
+
+class SharedFrameBuffer():
+    """
+    FrameBuffer counterpart for readers in other processes. Slots live in shared memory and are
+    written round robin, and each reader is sent (segment, slot, seq) on a queue of its own rather
+    than the frame. Readers copy the slot out and compare its sequence number before and after, so
+    a frame overwritten mid-copy is dropped instead of returned torn. Nothing is locked across
+    processes - a reader has (size - 1) frame intervals to copy a frame before its slot comes round.
+
+    Slots are sized for 'frame_size' up front. A larger frame (a replayed file, a raw sensor mode)
+    moves the buffer to a new segment sized for it, which readers map when they are sent its name.
+    Readers have to be created before the processes using them are forked.
+    """
+
+    def __init__(self, size, frame_size, channels=3, context=None):
+        if size < 2:
+            raise ValueError("Frame buffer needs at least two slots")
+        self.logger = logging.getLogger("buffer")
+        self.context = context or multiprocessing.get_context('fork')
+        self.size = size
+        self.segment = None
+        self.generation = 0
+        self.queues = []
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.dropped = 0
+        self.warned = False
+        self.allocate(frame_size[0] * frame_size[1] * channels)
+
+    def allocate(self, capacity):
+        if self.segment is not None:
+            self.segment.unlink()
+        self.generation += 1
+        name = "spypi-{0}-{1}".format(os.getpid(), self.generation)
+        self.segment = SharedSegment(name, self.size, capacity)
+        self.segment.header['seq'] = -1
+
+    def close(self):
+        # Only the creating process should call this, once the others are done with it
+        with self.lock:
+            if self.segment is not None:
+                self.segment.unlink()
+                self.segment = None
+
+    def clear(self):
+        with self.lock:
+            if self.segment is not None:
+                self.segment.header['seq'] = -1
+
+    def __len__(self):
+        return int(np.count_nonzero(self.segment.header['seq'] >= 0))
+
+    def put(self, image, captured=None):
+        if image.dtype != np.uint8:
+            if not self.warned:
+                self.logger.warning("Dropping {} frames - only 8 bit frames can be shared".format(image.dtype))
+                self.warned = True
+            self.dropped += 1
+            return None
+        with self.lock:
+            if self.segment is None:
+                return None
+            if image.nbytes > self.segment.capacity:
+                self.logger.warning("Frame of {0} does not fit {1} byte shared slots - reallocating"
+                                    .format(image.shape, self.segment.capacity))
+                self.allocate(image.nbytes)
+            segment = self.segment
+            self.seq += 1
+            seq = self.seq
+            slot = seq % self.size
+            # Readers part way through copying this slot will see the change and drop their copy
+            segment.header['seq'][slot] = -1
+            np.copyto(segment.data[slot, :image.nbytes].reshape(image.shape), image)
+            now = time.time()
+            segment.header['timestamp'][slot] = now
+            segment.header['captured'][slot] = captured or now
+            segment.header['shape'][slot] = image.shape + (0,) * (3 - image.ndim)
+            segment.header['seq'][slot] = seq
+
+        for q in self.queues:
+            try:
+                q.put_nowait((segment.name, slot, seq))
+            except queue.Full:
+                # Reader has fallen behind - it only ever wants the newest frame anyway
+                pass
+        return seq
+
+    def reader(self):
+        q = self.context.Queue(2 * self.size)
+        self.queues.append(q)
+        return SharedFrameReader(self, q)
+
+
+class SharedFrameReader():
+
+    def __init__(self, buffer, messages):
+        self.buffer = buffer
+        self.queue = messages
+        self.segment = None
+        self.last_seq = 0
+        self.torn = 0
+
+    def get_latest(self, timeout):
+        try:
+            if timeout == 0:
+                item = self.queue.get_nowait()
+            else:
+                item = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return item
+
+    def get_segment(self, name):
+        if self.segment is None or self.segment.name != name:
+            try:
+                self.segment = SharedSegment(name, self.buffer.size)
+            except (OSError, ValueError):
+                # Replaced and unlinked since the message was sent
+                return None
+        return self.segment
+
+    def next(self, timeout=0):
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            item = self.get_latest(None if end is None else max(0.0, end - time.monotonic()))
+            if item is None:
+                return None
+            name, slot, seq = item
+            if seq <= self.last_seq:
+                continue
+            segment = self.get_segment(name)
+            frame = segment.read(slot, seq) if segment is not None else None
+            if frame is not None:
+                self.last_seq = seq
+                return frame
+            self.torn += 1
+
+
+class FrameScheduler():
+    """
+    Paces a reader to 'rate' frames per second by capture time. Ticks fall on a fixed grid of
+    deadlines and each tick takes the first frame captured at or after its deadline, so the output
+    rate is exact on average, no frame is returned twice and the only sleeps are up to a known
+    deadline. Ticks missed by a slow consumer are skipped rather than made up in a burst.
+    """
+
+    def __init__(self, reader, rate):
+        self.reader = reader
+        self.rate = rate
+        self.deadline = None
+        self.skipped = 0
+
+    def set_rate(self, rate):
+        if rate != self.rate:
+            if self.deadline is not None:
+                self.deadline += 1 / rate - 1 / self.rate
+            self.rate = rate
+
+    def next(self, timeout=1):
+        """
+        :return: Frame, or None if the next tick is more than 'timeout' seconds away or no frame arrived
+        """
+        if self.deadline is not None:
+            delay = self.deadline - time.time()
+            if delay > timeout:
+                time.sleep(timeout)
+                return None
+            if delay > 0:
+                time.sleep(delay)
+
+        deadline = self.deadline or 0
+        end = time.monotonic() + timeout
+        while True:
+            frame = self.reader.next(timeout=max(0.0, end - time.monotonic()))
+            if frame is None:
+                return None
+            if frame.captured >= deadline:
+                break
+            # Captured before the tick - wait for the camera to commit a newer one
+            frame.release()
+
+        period = 1 / self.rate
+        if self.deadline is None or frame.captured - self.deadline >= period:
+            # First frame, or the consumer fell behind - restart the grid from this frame
+            if self.deadline is not None:
+                self.skipped += int((frame.captured - self.deadline) / period)
+            self.deadline = frame.captured + period
+        else:
+            self.deadline += period
+        return frame
@@ -1,20 +1,37 @@
+import glob
 import json
 import logging
 import os
 import time
 from collections import deque
+from os.path import join
 
-import ArducamSDK
 import cv2
 import numpy as np
-import picamera
-from picamera import PiCamera
-from picamera.array import PiRGBAnalysis
 
+# Hardware SDKs are only needed by their own camera types, so a build box
+# without them can still run the synthetic and replay cameras
+try:
+    import ArducamSDK
+except ImportError:
+    ArducamSDK = None
+try:
+    import picamera
+    from picamera import PiCamera
+    from picamera.array import PiRGBAnalysis
+except ImportError:
+    picamera = PiCamera = None
+    PiRGBAnalysis = object
+
+from spypi import metrics
+from spypi.buffer import FrameBuffer
+from spypi.encoder import Segmenter
 from spypi.error import CameraConfigurationException, ArducamException
-from spypi.lib.ImageConvert import convert_image
+from spypi.lib.ImageConvert import ImageConverter, build_raw_lut
 from spypi.resources import get_resource
-from spypi.utils import MultiCounter, start_thread, timestamp, ddrate
+from spypi.utils import MultiCounter, CountingFile, start_thread, timestamp, ddrate
+
+ARDUCAM_ERRORS = metrics.counter('spypi_arducam_errors_total', "Arducam SDK errors", ['camera', 'error'])
 
 
 class Camera():
@@ -31,11 +48,19 @@ class Camera():
         self.extra_info = []
         self.framerate = 30
         self.logger = logging.getLogger(self.camera_type)
+        # Identifies the camera in metrics - set to its connection name by the processor
+        self.name = self.camera_type
         self.log_metrics = False
         self.ignore_warnings = False
         self.log_extra_info = False
-        self.images = deque(maxlen=5)
+        self.images = FrameBuffer(5)
+        # Off when the caller reads frames itself - a reader thread would convert into the same buffers
+        self.read_thread = True
         self.image_counter = MultiCounter(50)
+        self.frames = 0
+        self.max_fps = config['max_fps']
+        self.next_frame_at = 0
+        self.skipped = 0
 
     @classmethod
     def create(cls, config):
@@ -48,11 +73,36 @@ class Camera():
             return PiCamDirect(config)
         elif cam == 'usb':
             return UsbCam(config)
+        elif cam == 'synthetic':
+            return SyntheticCam(config)
+        elif cam == 'replay':
+            return ReplayCam(config)
 
         raise ValueError("Unknown camera type: {}".format(cam))
 
-    def add_image(self, image):
-        self.images.append(image)
+    def skip_frame(self):
+        """
+        True if a frame arriving now would take the camera over max_fps. Checked before a frame is
+        converted, so the skipped ones cost next to nothing.
+        """
+        if not self.max_fps:
+            return False
+        now = time.monotonic()
+        if now < self.next_frame_at:
+            self.skipped += 1
+            return True
+        # Deadlines on a fixed grid so jitter doesn't lower the rate, reset after falling behind
+        self.next_frame_at += 1 / self.max_fps
+        if self.next_frame_at < now:
+            self.next_frame_at = now + 1 / self.max_fps
+        return False
+
+    def add_image(self, image, captured=None):
+        """
+        :param captured: time.time() the frame was read from the sensor, if it was before now
+        """
+        self.images.put(image, captured)
+        self.frames += 1
 
         if self.image_counter.increment():
             # No need to fetch every single frame - it causes data errors
@@ -61,7 +111,8 @@ class Camera():
 
             # Just for metrics
             if self.log_metrics:
-                self.logger.debug("Camera // framerate: {}".format(self.image_counter.get_rate(2)))
+                self.logger.debug("Camera // framerate: {0} // dropped: {1} // skipped: {2}"
+                                  .format(self.image_counter.get_rate(2), self.images.dropped, self.skipped))
 
     def connect(self):
         pass
@@ -78,10 +129,8 @@ class Camera():
         self.start()
         self.logger.info("Restart done!")
 
-    def next_image(self):
-        if len(self.images) > 1:
-            i = self.images[0].copy()
-            return i
+    def get_reader(self):
+        return self.images.reader()
 
     def read_next_frame(self):
         pass
@@ -94,6 +143,8 @@ class PiCam(Camera):
 
     def __init__(self, config):
         super(PiCam, self).__init__(config)
+        if picamera is None:
+            raise CameraConfigurationException("Unable to import picamera - have you run the install script?")
 
         sz = 32 * round(self.frame_size[0] / 32), 16 * round(self.frame_size[1] / 16)
 
@@ -120,7 +171,7 @@ class PiCam(Camera):
     def start(self):
         self.logger.info("Starting picam")
         self.connect()
-        self.cam.start_recording(PiCamBuffer(self.cam, self.add_image), 'rgb')
+        self.cam.start_recording(PiCamBuffer(self.cam, self.add_image, self.skip_frame), 'rgb')
         self.logger.info("Picam thread started")
 
     def stop(self):
@@ -159,10 +210,12 @@ class PiCamDirect(PiCam):
         while True:
             if self.annotation_scale:
                 self.cam.annotate_text = " {} ".format(timestamp())
-            image = self.get_blank_image()
-            self.cam.capture(image, 'rgb', use_video_port=True)
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            self.add_image(image)
+            if not self.skip_frame():
+                image = self.get_blank_image()
+                self.cam.capture(image, 'rgb', use_video_port=True)
+                captured = time.time()
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                self.add_image(image, captured)
             time.sleep(0.13)
 
     def new_file(self):
@@ -177,14 +230,16 @@ class PiCamDirect(PiCam):
             time.sleep(0.5)
         self.logger.info("Stream ready! Start capture")
 
+        segmenter = Segmenter(self.vstream.max_file_size, self.vstream.segmenter.max_duration)
         filename = self.new_file()
-        self.cam.start_recording(filename, format=self.codec)
+        output = CountingFile(filename)
+        self.cam.start_recording(output, format=self.codec)
         self.logger.info("Recording started")
 
         while True:
-            self.cam.wait_recording(5)
-            disk_size = self.vstream.get_filesize(filename)
-            if round(disk_size) >= self.vstream.max_file_size:
+            self.cam.wait_recording(1)
+            if segmenter.progress(output.bytes_written) >= 1:
+                disk_size = round(output.bytes_written * 1e-6, 2)
                 if self.log_metrics:
                     cx += 1
                     data_rate.increment()
@@ -192,22 +247,30 @@ class PiCamDirect(PiCam):
                     self.logger.debug(
                         "Data rate: {0} GB/day // count: {1}".format(ddrate(data_rate.get_rate(), sizes), cx))
 
-                old_filename = filename
+                old_filename, old_output = filename, output
                 filename = self.new_file()
+                output = CountingFile(filename)
                 self.logger.debug(
-                    "Max size exceeded ({0}). Start new file: {1}".format(disk_size, filename))
-                self.cam.split_recording(filename)
-                os.rename(old_filename, old_filename.replace("LOCKED-", ""))
+                    "Segment limit reached ({0} MB). Start new file: {1}".format(disk_size, filename))
+                # picamera only splits on a keyframe, so segments are always aligned
+                self.cam.split_recording(output)
+                segmenter.start()
+                old_output.close()
+                self.vstream.finish_file(old_filename)
 
 
 class PiCamBuffer(PiRGBAnalysis):
-    def __init__(self, camera, handler):
+    def __init__(self, camera, handler, skip=None):
         super(PiCamBuffer, self).__init__(camera)
         self.handler = handler
+        self.skip = skip
 
     def analyze(self, image):
+        if self.skip is not None and self.skip():
+            return
+        captured = time.time()
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        self.handler(image)
+        self.handler(image, captured)
 
 
 class UsbCam(Camera):
@@ -224,6 +287,8 @@ class ArduCam(Camera):
 
     def __init__(self, config):
         super(ArduCam, self).__init__(config)
+        if ArducamSDK is None:
+            raise CameraConfigurationException("Unable to import ArducamSDK - have you run the install script?")
 
         self.register_config_path = config['arducam_registers'] or get_resource('default_registers.json')
         self.usb_version = None
@@ -240,6 +305,11 @@ class ArduCam(Camera):
         self.height = 0
         self.field_index = 0
         self.running = False
+        self.converter = None
+        self.captured = None
+        self.lut = None
+        self.raw_gamma = config['raw_gamma']
+        self.raw_black_level = config['raw_black_level']
         self.error_counter = MultiCounter()
         self.data_fields = {
             'TIME': 0,
@@ -248,16 +318,16 @@ class ArduCam(Camera):
             'LUM2': 0,
         }
 
-        with open(self.register_config_path, 'r') as f:
-            self.register_config = json.load(f)
+        self.register_config = load_register_config(self.register_config_path)
 
     def read_frames(self):
         while True and self.running:
             try:
                 image = self.read_next_frame()
                 if image is not None:
-                    self.add_image(image)
+                    self.add_image(image, self.captured)
             except ArducamException as e:
+                ARDUCAM_ERRORS.labels(camera=self.name, error=e.root_cause).inc()
                 self.error_counter.increment()
                 if self.max_error_rate < self.error_counter.get_rate():
                     break
@@ -283,7 +353,8 @@ class ArduCam(Camera):
         start_code = ArducamSDK.Py_ArduCam_beginCaptureImage(self.handle)
         if start_code != 0:
             raise ArducamException("Error starting capture thread", code=start_code)
-        start_thread(self.read_frames)
+        if self.read_thread:
+            start_thread(self.read_frames)
         self.extra_info = self.get_extra_label_info()
         self.logger.info("Arducam thread started")
 
@@ -324,33 +395,15 @@ class ArduCam(Camera):
         raise ArducamException("Failed to connect to camera", code=code)
 
     def configure(self):
-        camera_parameter = self.register_config["camera_parameter"]
-        self.width = int(camera_parameter["SIZE"][0])
-        self.height = int(camera_parameter["SIZE"][1])
-        BitWidth = camera_parameter["BIT_WIDTH"]
-        ByteLength = 1
-        if BitWidth > 8 and BitWidth <= 16:
-            ByteLength = 2
-            self.save_raw = True
-        FmtMode = int(camera_parameter["FORMAT"][0])
-        self.color_mode = (int)(camera_parameter["FORMAT"][1])
-
-        I2CMode = camera_parameter["I2C_MODE"]
-        I2cAddr = int(camera_parameter["I2C_ADDR"], 16)
-        TransLvl = int(camera_parameter["TRANS_LVL"])
-        self.cam_config = {
-            "u32CameraType": 0x4D091031,
-            "u32Width": self.width, "u32Height": self.height,
-            "usbType": 0,
-            "u8PixelBytes": ByteLength,
-            "u16Vid": 0,
-            "u32Size": 0,
-            "u8PixelBits": BitWidth,
-            "u32I2cAddr": I2cAddr,
-            "emI2cMode": I2CMode,
-            "emImageFmtMode": FmtMode,
-            "u32TransLvl": TransLvl
-        }
+        self.cam_config, self.color_mode = get_arducam_config(self.register_config)
+        self.width = self.cam_config['u32Width']
+        self.height = self.cam_config['u32Height']
+        self.save_raw = self.cam_config['u8PixelBytes'] == 2
+        self.lut = get_raw_lut(self.cam_config, self.raw_gamma, self.raw_black_level)
+        if self.lut is not None:
+            self.logger.info("Reducing raw frames through a lookup table (gamma: {0}, black level: {1})"
+                             .format(self.raw_gamma, self.raw_black_level))
+        self.converter = None
 
         self.connect_cam()
         self.configure_board("board_parameter")
@@ -398,7 +451,7 @@ class ArduCam(Camera):
             self.logger.debug("Writing register to cam {0}: {1}".format(self.dev_id, r))
             ArducamSDK.Py_ArduCam_writeSensorReg(self.handle, int(r[0], 16), int(r[1], 16))
 
-    def read_next_frame(self):
+    def read_next_frame(self, raw=False):
         code = ArducamSDK.Py_ArduCam_captureImage(self.handle)
         if code > 255:
             raise ArducamException("Error capturing image", code=code)
@@ -407,10 +460,21 @@ class ArduCam(Camera):
                 rtn_val, data, rtn_cfg = ArducamSDK.Py_ArduCam_readImage(self.handle)
                 if rtn_val != 0 or rtn_cfg['u32Size'] == 0:
                     raise ArducamException("Bad image read! Datasize was {}".format(rtn_cfg['u32Size']), code=rtn_val)
-                return convert_image(data, rtn_cfg, self.color_mode)
+                self.captured = time.time()
+                if raw:
+                    return bytes(data), rtn_cfg
+                if self.skip_frame():
+                    return None
+                return self.get_converter(rtn_cfg).convert(data, rtn_cfg['u32Size'])
             finally:
                 ArducamSDK.Py_ArduCam_del(self.handle)
 
+    def get_converter(self, rtn_cfg):
+        if self.converter is None or not self.converter.matches(rtn_cfg, self.color_mode):
+            self.logger.debug("Allocating converter for {0}x{1}".format(rtn_cfg['u32Width'], rtn_cfg['u32Height']))
+            self.converter = ImageConverter(rtn_cfg, self.color_mode, self.lut)
+        return self.converter
+
     def get_extra_label_info(self):
         if self.data_fields['LUM2'] == 0:
             self.data_fields['LUM2'] = ArducamSDK.Py_ArduCam_readSensorReg(self.handle, int(12546))[1]
@@ -428,3 +492,174 @@ class ArduCam(Camera):
             self.data_fields['ISO'],
             self.data_fields['LUM1'],
             self.data_fields['LUM2'])]
+
+
+class SyntheticCam(Camera):
+
+    def __init__(self, config):
+        super(SyntheticCam, self).__init__(config)
+        self.source_framerate = config['source_framerate']
+        self.running = False
+        self.pattern = None
+        self.frame_index = 0
+        self.thread = None
+
+    def start(self):
+        self.logger.info("Starting synthetic capture at {}"
+                         .format("{} fps".format(self.source_framerate) if self.source_framerate else "max rate"))
+        self.pattern = self.get_pattern()
+        self.running = True
+        if self.read_thread:
+            self.thread = start_thread(self.read_frames)
+
+    def stop(self):
+        self.logger.info("Stopping {} capture".format(self.camera_type))
+        self.running = False
+        # Wait for the frame being read, so nothing the reader uses is released under it
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.images.clear()
+
+    def read_frames(self):
+        period = 1 / self.source_framerate if self.source_framerate else 0
+        deadline = time.perf_counter()
+        while self.running:
+            captured = time.time()
+            image = None if self.skip_frame() else self.read_next_frame()
+            if image is not None:
+                self.add_image(image, captured)
+            if period:
+                deadline += period
+                delay = deadline - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Fell behind - don't try to catch up with a burst of frames
+                    deadline = time.perf_counter()
+
+    def get_pattern(self):
+        # Colour bars over a grey ramp, twice the frame width so it can be scrolled
+        w, h = self.frame_size
+        bars = np.array([[255, 255, 255], [0, 255, 255], [255, 255, 0], [0, 255, 0],
+                         [255, 0, 255], [0, 0, 255], [255, 0, 0], [0, 0, 0]], dtype=np.uint8)
+        x = np.arange(2 * w) % w
+        pattern = np.empty((h, 2 * w, 3), dtype=np.uint8)
+        split = 2 * h // 3
+        pattern[:split] = bars[x * len(bars) // w]
+        pattern[split:] = (x * 255 // w).astype(np.uint8)[:, None]
+        return pattern
+
+    def read_next_frame(self):
+        w = self.frame_size[0]
+        offset = (self.frame_index * 4) % w
+        self.frame_index += 1
+        return np.ascontiguousarray(self.pattern[:, offset:offset + w])
+
+
+class ReplayCam(SyntheticCam):
+
+    def __init__(self, config):
+        super(ReplayCam, self).__init__(config)
+        self.source = config['replay_source']
+        if not self.source:
+            raise CameraConfigurationException("Replay camera requires a replay_source")
+        self.register_config_path = config['arducam_registers'] or get_resource('default_registers.json')
+        self.capture = None
+        self.raw_frames = []
+        self.cam_config = {}
+        self.color_mode = None
+        self.converter = None
+        self.raw_gamma = config['raw_gamma']
+        self.raw_black_level = config['raw_black_level']
+
+    def start(self):
+        self.logger.info("Starting replay of {}".format(self.source))
+        if os.path.isdir(self.source):
+            self.load_raw_frames()
+        else:
+            self.capture = cv2.VideoCapture(self.source)
+            if not self.capture.isOpened():
+                raise CameraConfigurationException("Unable to open replay source: {}".format(self.source))
+            self.frame_size = (int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                               int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self.running = True
+        if self.read_thread:
+            self.thread = start_thread(self.read_frames)
+
+    def stop(self):
+        super(ReplayCam, self).stop()
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+    def load_raw_frames(self):
+        # Raw dumps are held in memory so disk reads don't skew the measurements
+        self.cam_config, self.color_mode = get_arducam_config(load_register_config(self.register_config_path))
+        lut = get_raw_lut(self.cam_config, self.raw_gamma, self.raw_black_level)
+        self.converter = ImageConverter(self.cam_config, self.color_mode, lut)
+        self.raw_frames = []
+        for path in sorted(glob.glob(join(self.source, "*.raw"))):
+            with open(path, 'rb') as f:
+                self.raw_frames.append(f.read())
+        if not self.raw_frames:
+            raise CameraConfigurationException("No raw frames found in {}".format(self.source))
+        self.logger.info("Loaded {} raw frames".format(len(self.raw_frames)))
+        h, w = self.read_next_frame().shape[:2]
+        self.frame_size = (w, h)
+
+    def read_next_frame(self):
+        if self.capture is not None:
+            ok, image = self.capture.read()
+            if not ok:
+                # Loop back to the start of the recording
+                self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ok, image = self.capture.read()
+            return image if ok else None
+
+        data = self.raw_frames[self.frame_index % len(self.raw_frames)]
+        self.frame_index += 1
+        return self.converter.convert(data, len(data))
+
+
+def load_register_config(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def get_raw_lut(cam_config, gamma, black_level):
+    # The lookup costs ~9x the shift (1.1 vs 0.12 ms for a 1280x964 frame - np.take, as cv2.LUT only
+    # takes 8 bit input) and at the defaults only rounds where the shift truncates, so it is opt-in
+    if cam_config['u8PixelBytes'] != 2 or (gamma == 1 and black_level == 0):
+        return None
+    return build_raw_lut(cam_config['u8PixelBits'], gamma, black_level)
+
+
+def get_arducam_config(register_config):
+    camera_parameter = register_config["camera_parameter"]
+    width = int(camera_parameter["SIZE"][0])
+    height = int(camera_parameter["SIZE"][1])
+    BitWidth = camera_parameter["BIT_WIDTH"]
+    ByteLength = 1
+    if BitWidth > 8 and BitWidth <= 16:
+        ByteLength = 2
+    FmtMode = int(camera_parameter["FORMAT"][0])
+    color_mode = (int)(camera_parameter["FORMAT"][1])
+
+    I2CMode = camera_parameter["I2C_MODE"]
+    I2cAddr = int(camera_parameter["I2C_ADDR"], 16)
+    TransLvl = int(camera_parameter["TRANS_LVL"])
+    cam_config = {
+        "u32CameraType": 0x4D091031,
+        "u32Width": width, "u32Height": height,
+        "usbType": 0,
+        "u8PixelBytes": ByteLength,
+        "u16Vid": 0,
+        "u32Size": 0,
+        "u8PixelBits": BitWidth,
+        "u32I2cAddr": I2cAddr,
+        "emI2cMode": I2CMode,
+        "emImageFmtMode": FmtMode,
+        "u32TransLvl": TransLvl
+    }
+    return cam_config, color_mode
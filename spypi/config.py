@@ -1,5 +1,5 @@
 import os
-from collections import Mapping
+from collections.abc import Mapping
 from copy import deepcopy
 
 import yaml
@@ -15,7 +15,7 @@ def config_schema() -> Schema:
     from schema import And, Or
     return Schema({
         'device': {
-            'camera': Or('picam', 'arducam', 'usb', 'picam-direct'),
+            'camera': Or('picam', 'arducam', 'usb', 'picam-direct', 'synthetic', 'replay'),
             'device_id': int,
             'frame_size': [int, int],
             'init_delay': Or(float, int),
@@ -25,31 +25,107 @@ def config_schema() -> Schema:
             'cam_rotate': Or(0, 90, 180, 270),
             'codec': Or('h264'),
             'annotation_scale': int,
+            'raw_gamma': And(Or(float, int), lambda g: g > 0),
+            'raw_black_level': And(int, lambda b: b >= 0),
+            'source_framerate': Or(float, int),
+            'replay_source': Or(None, And(str, len)),
+            'max_fps': And(Or(float, int), lambda n: n >= 0),
+            'cpu_budget': And(Or(float, int), lambda n: n >= 0),
+        },
+        Optional('devices'): Or(None, [{
+            'name': And(str, len),
+            Optional('device'): Or(None, dict),
+            Optional('processing'): Or(None, dict),
+        }]),
+        Optional('supervisor'): {
+            'workers': And(int, lambda n: n >= 0),
         },
         Optional('connection'): {
             'name': And(str, len),
             'host': And(str, len),
             'timeout': int,
+            'mode': Or('sync', 'async'),
+            'max_in_flight': And(int, lambda n: n > 0),
+            'image_timeout': Or(None, float, int),
+            'video_timeout': Or(None, float, int),
+            'pool_size': And(int, lambda n: n > 0),
+            'chunk_size': And(Or(float, int), lambda n: n >= 0),
+            'upload_rate_limit': And(Or(float, int), lambda n: n >= 0),
+            'retries': And(int, lambda n: n >= 0),
+            'retry_backoff': Or(float, int),
+            'jpeg_quality': And(int, lambda q: 0 < q <= 100),
+            'encode_workers': And(int, lambda n: n > 0),
+            'encode_queue': And(int, lambda n: n > 0),
         },
         Optional('processing'): {
             'target_video_framerate': Or(int, float),
             'target_web_framerate': Or(int, float),
-            'video_fr_pid': Or(None, [Or(int, float), Or(int, float),
+            # No longer used - still accepted so existing configs validate
+            Optional('video_fr_pid'): Or(None, [Or(int, float), Or(int, float),
                                       Or(int, float), Or(int, float), Or(int, float),  Or(int, float)]),
-            'web_fr_pid': Or(None, [Or(int, float), Or(int, float),
+            Optional('web_fr_pid'): Or(None, [Or(int, float), Or(int, float),
                                       Or(int, float), Or(int, float), Or(int, float),  Or(int, float)]),
             'show_fps': Or(None, bool),
             'recording_directory': Or(None, And(str, len)),
             'record_video': Or(None, bool),
+            'record_mode': Or('continuous', 'event'),
+            'event_preroll': And(Or(float, int), lambda n: n >= 0),
+            'event_postroll': And(Or(float, int), lambda n: n > 0),
+            'event_port': And(int, lambda n: 0 <= n < 65536),
+            'adaptive': {
+                'enabled': bool,
+                'motion_framerate': And(Or(float, int), lambda n: n > 0),
+                'keepalive_framerate': And(Or(float, int), lambda n: n > 0),
+                'motion_hold': And(Or(float, int), lambda n: n >= 0),
+                'latency_target': And(Or(float, int), lambda n: n > 0),
+                'min_quality': And(int, lambda q: 0 < q <= 100),
+                'quality_step': And(int, lambda q: q > 0),
+                'min_scale': And(Or(float, int), lambda n: 0 < n <= 1),
+            },
+            'motion': {
+                'enabled': bool,
+                'scale': And(Or(float, int), lambda n: 0 < n <= 1),
+                'roi': [int, int, int, int],
+                'mask': Or(None, And(str, len)),
+                'alpha': And(Or(float, int), lambda n: 0 < n <= 1),
+                'pixel_threshold': And(int, lambda n: 0 <= n < 256),
+                'trigger_score': And(Or(float, int), lambda n: 0 <= n <= 1),
+            },
+            'multiprocess': bool,
+            'shared_slots': And(int, lambda n: n >= 2),
             'send_video': Or(None, bool),
+            'upload_workers': And(int, lambda n: n > 0),
+            'upload_order': Or('oldest', 'newest'),
             'send_images': Or(None, bool),
             'crop': [int, int, int, int],
-            'video_filesize': Or(float, int),
+            'video_filesize': And(Or(float, int), lambda n: n >= 0),
+            'video_duration': And(Or(float, int), lambda n: n >= 0),
+            'video_keyframe_split': bool,
+            'video_queue': And(int, lambda n: n > 0),
+            'video_encoder': {
+                'backend': Or('opencv', 'ffmpeg', 'pyav'),
+                'codec': Or(None, And(str, len)),
+                'container': Or(None, And(str, len)),
+                'crf': Or(None, And(int, lambda n: 0 <= n <= 63)),
+                'bitrate': Or(None, And(Or(float, int), lambda n: n > 0)),
+                'preset': Or(None, And(str, len)),
+                'gop': Or(None, And(int, lambda n: n > 0)),
+            },
             'rotation': Or(float, int),
             'image_size': Or(None, [int, int]),
             'data_bar_web': [Or(float, int), int],
             'data_bar_video': [Or(float, int), int],
         },
+        Optional('metrics'): {
+            'enabled': bool,
+            'port': And(int, lambda n: 0 < n < 65534),
+        },
+        Optional('trace'): {
+            'enabled': bool,
+            'filename': And(str, len),
+            'sample_every': And(int, lambda n: n > 0),
+            'max_size': And(Or(float, int), lambda n: n > 0),
+        },
         Optional('logging'): {
             'level': Or('info', 'debug', 'INFO', 'DEBUG'),
             'filename': Or(None, And(str, len)),
@@ -68,7 +144,36 @@ def load_config(path):
 
     path = cfgm['logging']['filename']
     cfgm['logging']['filename'] = os.path.abspath(path)
+    path = cfgm['trace']['filename']
+    cfgm['trace']['filename'] = os.path.abspath(path)
+
+    _resolve_paths(cfgm)
+    _validate(cfgm)
+
+    names = [d['name'] for d in cfgm.get('devices') or []]
+    if len(set(names)) != len(names):
+        raise ConfigValidationError("Device names must be unique: {}".format(names))
+    for device_config in get_device_configs(cfgm):
+        _validate(device_config)
+    return cfgm
+
+
+def get_device_configs(config):
+    """
+    One complete config per entry in 'devices': the top level config with the entry's device and
+    processing sections merged over it, posting as the entry's name
+    """
+    configs = []
+    for entry in config.get('devices') or []:
+        overrides = {k: entry.get(k) or {} for k in ('device', 'processing')}
+        cfg = merge_dict({k: v for k, v in config.items() if k != 'devices'}, overrides, True)
+        cfg['connection']['name'] = entry['name']
+        _resolve_paths(cfg)
+        configs.append(cfg)
+    return configs
 
+
+def _resolve_paths(cfgm):
     path = cfgm['processing']['recording_directory']
     cfgm['processing']['recording_directory'] = os.path.abspath(path)
 
@@ -77,10 +182,21 @@ def load_config(path):
         path = os.path.abspath(path)
         if not os.path.exists(path):
             raise FileNotFoundError("Cannot find {} ".format(path))
-        cfg['device']['arducam_registers'] = path
+        cfgm['device']['arducam_registers'] = path
 
-    _validate(cfgm)
-    return cfgm
+    path = cfgm['processing']['motion']['mask']
+    if path is not None:
+        path = os.path.abspath(path)
+        if not os.path.exists(path):
+            raise FileNotFoundError("Cannot find {} ".format(path))
+        cfgm['processing']['motion']['mask'] = path
+
+    path = cfgm['device']['replay_source']
+    if path is not None:
+        path = os.path.abspath(path)
+        if not os.path.exists(path):
+            raise FileNotFoundError("Cannot find {} ".format(path))
+        cfgm['device']['replay_source'] = path
 
 
 def _validate(raw_config: dict):
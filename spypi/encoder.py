@@ -0,0 +1,261 @@
+import fractions
+import logging
+import shutil
+import subprocess
+import time
+
+import cv2
+
+try:
+    import av
+    # Newer PyAV only accepts the enum, older versions the name
+    KEYFRAME = getattr(getattr(av.video.frame, 'PictureType', None), 'I', 'I')
+except ImportError:
+    av = None
+
+from spypi.error import EncoderException
+from spypi.utils import start_thread
+
+
+class Segmenter():
+    """
+    Tracks how far the current segment is towards its size (MB) and duration (seconds) limits,
+    from byte counts the writer already has rather than by stat-ing the file. 0 disables a limit.
+    """
+
+    def __init__(self, max_size=0, max_duration=0, align_keyframes=False):
+        self.max_bytes = max_size * 1e6
+        self.max_duration = max_duration
+        self.align_keyframes = align_keyframes
+        self.started = time.monotonic()
+
+    def start(self):
+        self.started = time.monotonic()
+
+    def progress(self, size):
+        """
+        :param size: bytes written to the current segment
+        :return: fraction of the nearest limit reached - 1 or more means the segment is due to split
+        """
+        progress = size / self.max_bytes if self.max_bytes else 0
+        if self.max_duration:
+            progress = max(progress, (time.monotonic() - self.started) / self.max_duration)
+        return progress
+
+
+class VideoWriter():
+    """
+    One open video file. Backends take BGR frames of a fixed resolution and mirror the
+    cv2.VideoWriter write/release interface. bytes_written is None where the backend
+    can't report it.
+    """
+
+    DEFAULT_CODEC = None
+    DEFAULT_CONTAINER = None
+
+    def __init__(self, filename, resolution, fps, settings):
+        self.filename = filename
+        self.resolution = tuple(resolution)
+        self.fps = fps
+        self.codec = settings.get('codec') or self.DEFAULT_CODEC
+        self.crf = settings.get('crf')
+        self.bitrate = settings.get('bitrate')
+        self.preset = settings.get('preset')
+        self.gop = settings.get('gop') or max(1, round(2 * fps))
+        self.logger = logging.getLogger("encoder")
+        self.frames = 0
+        self.output_frames = 0
+        self.output_bytes = None
+
+    @property
+    def bytes_written(self):
+        if not self.output_frames:
+            return self.output_bytes
+        # Encoders hold frames back for lookahead - count those at the average frame size so far
+        return self.output_bytes + (self.frames - self.output_frames) * self.output_bytes / self.output_frames
+
+    @classmethod
+    def get_extension(cls, settings):
+        return settings.get('container') or cls.DEFAULT_CONTAINER
+
+    @staticmethod
+    def check_available():
+        pass
+
+    def next_is_keyframe(self):
+        # Backends which control their GOP force a keyframe every 'gop' frames
+        return self.frames % self.gop == 0
+
+    def write(self, frame):
+        self.encode(frame)
+        self.frames += 1
+
+    def encode(self, frame):
+        pass
+
+    def release(self):
+        pass
+
+
+class OpenCVWriter(VideoWriter):
+    """
+    cv2.VideoWriter - codec is a fourcc. Quality, preset and GOP are left to the OpenCV build.
+    """
+
+    DEFAULT_CODEC = 'XVID'
+    DEFAULT_CONTAINER = 'avi'
+
+    def __init__(self, filename, resolution, fps, settings):
+        super(OpenCVWriter, self).__init__(filename, resolution, fps, settings)
+        self.writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*self.codec), fps, self.resolution)
+        if not self.writer.isOpened():
+            raise EncoderException("OpenCV could not open {0} with codec {1}".format(filename, self.codec))
+
+    def next_is_keyframe(self):
+        # Keyframe placement is up to the OpenCV build
+        return True
+
+    def encode(self, frame):
+        self.writer.write(frame)
+
+    def release(self):
+        self.writer.release()
+
+
+class FFmpegWriter(VideoWriter):
+    """
+    ffmpeg subprocess fed raw BGR frames over stdin, so any codec the installed ffmpeg
+    has (software libx264 by default) can be used without OpenCV being built against it
+    """
+
+    DEFAULT_CODEC = 'libx264'
+    DEFAULT_CONTAINER = 'mp4'
+
+    def __init__(self, filename, resolution, fps, settings):
+        super(FFmpegWriter, self).__init__(filename, resolution, fps, settings)
+        self.output_bytes = 0
+        self.process = subprocess.Popen(self.get_command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        start_thread(self.read_progress)
+
+    @staticmethod
+    def check_available():
+        if shutil.which('ffmpeg') is None:
+            raise EncoderException("ffmpeg encoder requires the ffmpeg executable on PATH")
+
+    def get_command(self):
+        command = [
+            'ffmpeg', '-loglevel', 'error', '-y',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+            '-s', '{0}x{1}'.format(*self.resolution), '-r', str(self.fps),
+            '-i', '-',
+            '-c:v', self.codec, '-pix_fmt', 'yuv420p', '-g', str(self.gop),
+            '-force_key_frames', 'expr:gte(n,n_forced*{})'.format(self.gop),
+            # Flushed per packet so the reported size isn't held back by ffmpeg's output buffer
+            '-progress', 'pipe:1', '-nostats', '-flush_packets', '1',
+        ]
+        if self.bitrate:
+            command.extend(['-b:v', "{}k".format(self.bitrate)])
+        elif self.crf is not None:
+            command.extend(['-crf', str(self.crf)])
+        if self.preset:
+            command.extend(['-preset', self.preset])
+        if self.filename.endswith('.mp4'):
+            # Fragmented so a file cut short by a crash is still playable
+            command.extend(['-movflags', '+frag_keyframe+empty_moov'])
+        command.append(self.filename)
+        return command
+
+    def read_progress(self):
+        # ffmpeg reports frames and bytes output about twice a second
+        frames = 0
+        for line in self.process.stdout:
+            key, _, value = line.partition(b'=')
+            try:
+                if key == b'frame':
+                    frames = int(value)
+                elif key == b'total_size':
+                    self.output_bytes, self.output_frames = int(value), frames
+            except ValueError:
+                pass
+
+    def encode(self, frame):
+        try:
+            self.process.stdin.write(frame.data if frame.flags.c_contiguous else frame.tobytes())
+        except BrokenPipeError:
+            raise EncoderException("ffmpeg exited with code {0} while writing {1}".format(
+                self.process.poll(), self.filename))
+
+    def release(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        code = self.process.wait()
+        if code:
+            self.logger.error("ffmpeg exited with code {0} for {1}".format(code, self.filename))
+
+
+class PyAVWriter(VideoWriter):
+    """
+    In-process libav encoding through PyAV - same codecs as the ffmpeg backend without the pipe
+    """
+
+    DEFAULT_CODEC = 'libx264'
+    DEFAULT_CONTAINER = 'mp4'
+
+    def __init__(self, filename, resolution, fps, settings):
+        super(PyAVWriter, self).__init__(filename, resolution, fps, settings)
+        self.output_bytes = 0
+        options = {}
+        if self.filename.endswith('.mp4'):
+            options['movflags'] = '+frag_keyframe+empty_moov'
+        self.container = av.open(filename, mode='w', options=options)
+        # A fraction keeps rates like 29.97 and anything under 1 fps, which round() would lose
+        rate = fractions.Fraction(fps).limit_denominator(1001)
+        self.stream = self.container.add_stream(self.codec, rate=rate)
+        self.stream.width, self.stream.height = self.resolution
+        self.stream.pix_fmt = 'yuv420p'
+        self.stream.codec_context.gop_size = self.gop
+        # Same rate control as the ffmpeg backend - bitrate over crf, with the preset applying to either
+        codec_options = {}
+        if self.bitrate:
+            self.stream.bit_rate = int(self.bitrate * 1000)
+        elif self.crf is not None:
+            codec_options['crf'] = str(self.crf)
+        if self.preset:
+            codec_options['preset'] = self.preset
+        self.stream.options = codec_options
+
+    @staticmethod
+    def check_available():
+        if av is None:
+            raise EncoderException("pyav encoder requires PyAV (pip install av)")
+
+    def encode(self, frame):
+        frame = av.VideoFrame.from_ndarray(frame, format='bgr24')
+        if self.next_is_keyframe():
+            frame.pict_type = KEYFRAME
+        self.mux(self.stream.encode(frame))
+
+    def mux(self, packets):
+        for packet in packets:
+            self.output_bytes += packet.size
+            self.output_frames += 1
+            self.container.mux(packet)
+
+    def release(self):
+        self.mux(self.stream.encode(None))
+        self.container.close()
+
+
+WRITERS = {
+    'opencv': OpenCVWriter,
+    'ffmpeg': FFmpegWriter,
+    'pyav': PyAVWriter,
+}
+
+
+def get_writer_class(backend):
+    writer = WRITERS[backend]
+    writer.check_available()
+    return writer
@@ -42,6 +42,10 @@ class ImageReadException(BaseException):
     pass
 
 
+class EncoderException(BaseException):
+    pass
+
+
 class PiCamException(BaseException):
     def __init__(self, message, root_exception):
         BaseException.__init__(self)
@@ -0,0 +1,134 @@
+import json
+import logging
+import signal
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from spypi.model import JpegEncoder
+
+
+class EventRecorder():
+    """
+    Event mode front end for a VideoStream. While idle, frames are kept as JPEGs for the last
+    'preroll' seconds instead of being recorded. A trigger writes the pre-roll to a new file and
+    records until 'postroll' seconds after the last trigger, then closes the file.
+
+    The pre-roll is JPEG rather than the output codec so it works the same with every encoder
+    backend, and costs a fraction of the memory of raw frames.
+    """
+
+    def __init__(self, video_stream, preroll=5, postroll=10, quality=90, log_metrics=False):
+        self.logger = logging.getLogger("event")
+        self.video_stream = video_stream
+        self.preroll = preroll
+        self.postroll = postroll
+        self.log_metrics = log_metrics
+        self.encoder = JpegEncoder(quality)
+        self.frames = deque()
+        self.lock = threading.Lock()
+        self.recording_until = 0
+        self.recording = False
+        self.started = 0
+        self.events = 0
+
+    def trigger(self, source="manual"):
+        with self.lock:
+            now = time.monotonic()
+            idle = now >= self.recording_until
+            self.recording_until = now + self.postroll
+        if idle:
+            self.logger.debug("Event triggered by {}".format(source))
+
+    def is_recording(self):
+        return time.monotonic() < self.recording_until
+
+    def add_frame(self, frame, trace=None, release=None):
+        now = time.monotonic()
+        with self.lock:
+            active = now < self.recording_until
+            start, stop = active and not self.recording, self.recording and not active
+            self.recording = active
+            if start:
+                preroll = [f for _, f in self.frames]
+                self.frames.clear()
+
+        if start:
+            self.events += 1
+            self.started = now
+            self.video_stream.new_segment()
+            self.video_stream.add_encoded(preroll)
+            self.logger.info("Recording event {0} with {1} frames of pre-roll".format(self.events, len(preroll)))
+        elif stop:
+            self.video_stream.end_segment()
+            self.logger.info("Event {0} ended after {1} s".format(self.events, round(now - self.started, 1)))
+
+        if active:
+            self.video_stream.add_frame(frame, trace, release)
+            return
+
+        # Frames kept for the pre-roll may never be recorded, so their traces are left unfinished
+        try:
+            self.frames.append((now, self.encoder.encode(frame)))
+        finally:
+            if release is not None:
+                release(frame)
+        while self.frames and self.frames[0][0] < now - self.preroll:
+            self.frames.popleft()
+
+    def get_status(self):
+        return {
+            'recording': self.is_recording(),
+            'remaining': round(max(0.0, self.recording_until - time.monotonic()), 1),
+            'events': self.events,
+            'preroll_frames': len(self.frames),
+        }
+
+    def listen_signal(self, signum=signal.SIGUSR1):
+        # Has to be called from the main thread. Chains to any earlier handler so one signal
+        # triggers every camera in a multi-camera process.
+        previous = signal.getsignal(signum)
+
+        def handler(*args):
+            self.trigger("signal")
+            if callable(previous):
+                previous(*args)
+
+        signal.signal(signum, handler)
+        self.logger.info("Listening for event trigger on signal {}".format(signum))
+
+    def listen_http(self, port):
+        recorder = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                if self.path.rstrip('/') != '/trigger':
+                    self.send_error(404)
+                    return
+                recorder.trigger("http")
+                self.send_status()
+
+            def do_GET(self):
+                if self.path.rstrip('/') != '/status':
+                    self.send_error(404)
+                    return
+                self.send_status()
+
+            def send_status(self):
+                body = json.dumps(recorder.get_status()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('', port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.logger.info("Listening for event trigger on http://0.0.0.0:{}/trigger".format(port))
+        return server
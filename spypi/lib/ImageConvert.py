@@ -1,9 +1,17 @@
-import ArducamSDK
 import cv2
 import numpy as np
 
 global COLOR_BayerGB2BGR, COLOR_BayerRG2BGR, COLOR_BayerGR2BGR, COLOR_BayerBG2BGR
 
+# Mirrors FORMAT_MODE_* so raw dumps can be converted without the SDK installed
+FORMAT_MODE_RAW = 0
+FORMAT_MODE_RGB = 1
+FORMAT_MODE_YUV = 2
+FORMAT_MODE_JPG = 3
+FORMAT_MODE_MON = 4
+FORMAT_MODE_RAW_D = 5
+FORMAT_MODE_MON_D = 6
+
 COLOR_BayerBG2BGR = 46
 COLOR_BayerGB2BGR = 47
 COLOR_BayerRG2BGR = 48
@@ -73,28 +81,137 @@ def convert_image(data, cfg, color_mode):
     global COLOR_BayerGB2BGR, COLOR_BayerRG2BGR, COLOR_BayerGR2BGR, COLOR_BayerBG2BGR
     image = None
     emImageFmtMode = cfg['emImageFmtMode']
-    if emImageFmtMode == ArducamSDK.FORMAT_MODE_JPG:
+    if emImageFmtMode == FORMAT_MODE_JPG:
         image = JPGToMat(data, datasize)
-    if emImageFmtMode == ArducamSDK.FORMAT_MODE_YUV:
+    if emImageFmtMode == FORMAT_MODE_YUV:
         image = YUVToMat(data, Width, Height)
-    if emImageFmtMode == ArducamSDK.FORMAT_MODE_RGB:
+    if emImageFmtMode == FORMAT_MODE_RGB:
         image = RGB565ToMat(data, Width, Height)
-    if emImageFmtMode == ArducamSDK.FORMAT_MODE_MON:
+    if emImageFmtMode == FORMAT_MODE_MON:
         if cfg["u8PixelBytes"] == 2:
             image = dBytesToMat(data, bitWidth, Width, Height)
         else:
             image = np.frombuffer(data, np.uint8).reshape(Height, Width, 1)
-    if emImageFmtMode == ArducamSDK.FORMAT_MODE_RAW:
+    if emImageFmtMode == FORMAT_MODE_RAW:
         if cfg["u8PixelBytes"] == 2:
             image = dBytesToMat(data, bitWidth, Width, Height)
         else:
             image = np.frombuffer(data, np.uint8).reshape(Height, Width, 1)
         image = convert_color(image, color_mode)
-    if emImageFmtMode == ArducamSDK.FORMAT_MODE_RAW_D:
+    if emImageFmtMode == FORMAT_MODE_RAW_D:
         image = separationImage(data, Width, Height)
         image = convert_color(image, color_mode)
         pass
-    if emImageFmtMode == ArducamSDK.FORMAT_MODE_MON_D:
+    if emImageFmtMode == FORMAT_MODE_MON_D:
         image = separationImage(data, Width, Height)
         pass
     return image
+
+
+COLOR_CODES = {
+    0: COLOR_BayerRG2BGR,
+    1: COLOR_BayerGR2BGR,
+    2: COLOR_BayerGB2BGR,
+    3: COLOR_BayerBG2BGR,
+}
+
+
+def build_raw_lut(bit_width, gamma=1.0, black_level=0):
+    """
+    Table mapping every possible 16 bit sample to 8 bits, stretching [black_level, max] to
+    the full output range with an optional gamma curve instead of dropping the low bits
+    """
+    max_value = (1 << bit_width) - 1
+    if not 0 <= black_level < max_value:
+        raise ValueError("Black level must be between 0 and {}".format(max_value - 1))
+    x = np.arange(65536, dtype=np.float64)
+    x = np.clip((x - black_level) / (max_value - black_level), 0, 1)
+    if gamma != 1:
+        x **= 1 / gamma
+    return np.round(x * 255).astype(np.uint8)
+
+
+class ImageConverter():
+    """
+    Per-configuration equivalent of convert_image which writes into buffers allocated once up front.
+    The returned image is overwritten by the next call, so it must be consumed (or copied) first.
+    16 bit samples are mapped through 'lut' (see build_raw_lut) when given, otherwise shifted down.
+    """
+
+    def __init__(self, cfg, color_mode, lut=None):
+        self.width = cfg["u32Width"]
+        self.height = cfg["u32Height"]
+        self.bit_width = cfg["u8PixelBits"]
+        self.pixel_bytes = cfg["u8PixelBytes"]
+        self.mode = cfg['emImageFmtMode']
+        self.color_mode = color_mode
+        self.color_code = COLOR_CODES.get(color_mode)
+        self.lut = lut
+
+        h, w = self.height, self.width
+        self.rgb565 = self.gray = self.image = None
+        if self.mode == FORMAT_MODE_RGB:
+            self.rgb565 = np.empty((h, w), dtype=np.uint16)
+            self.image = np.empty((h, w, 4), dtype=np.uint8)
+        elif self.mode == FORMAT_MODE_YUV:
+            self.image = np.empty((h, w, 3), dtype=np.uint8)
+        elif self.mode in (FORMAT_MODE_MON, FORMAT_MODE_RAW):
+            if self.pixel_bytes == 2:
+                self.gray = np.empty((h, w, 1), dtype=np.uint8)
+        elif self.mode in (FORMAT_MODE_MON_D, FORMAT_MODE_RAW_D):
+            self.gray = np.empty((h, 2 * w, 1), dtype=np.uint8)
+
+        if self.mode in (FORMAT_MODE_RAW, FORMAT_MODE_RAW_D) and self.color_code is not None:
+            self.image = np.empty((h, w if self.mode == FORMAT_MODE_RAW else 2 * w, 3), dtype=np.uint8)
+
+    def matches(self, cfg, color_mode):
+        return (cfg["u32Width"], cfg["u32Height"], cfg["u8PixelBits"], cfg["u8PixelBytes"],
+                cfg['emImageFmtMode'], color_mode) == \
+               (self.width, self.height, self.bit_width, self.pixel_bytes, self.mode, self.color_mode)
+
+    def convert(self, data, datasize=None):
+        if self.mode == FORMAT_MODE_JPG:
+            return JPGToMat(data, datasize)
+        if self.mode == FORMAT_MODE_YUV:
+            src = np.frombuffer(data, np.uint8).reshape(self.height, self.width, 2)
+            return cv2.cvtColor(src, cv2.COLOR_YUV2BGR_YUYV, dst=self.image)
+        if self.mode == FORMAT_MODE_RGB:
+            return self.rgb565_to_mat(data)
+        if self.mode == FORMAT_MODE_MON:
+            return self.mon_to_mat(data)
+        if self.mode == FORMAT_MODE_RAW:
+            return self.apply_color(self.mon_to_mat(data))
+        if self.mode == FORMAT_MODE_RAW_D:
+            return self.apply_color(self.separate(data))
+        if self.mode == FORMAT_MODE_MON_D:
+            return self.separate(data)
+
+    def rgb565_to_mat(self, data):
+        # Byte swap and vertical flip in a single copy, then let OpenCV expand 565 to BGRA
+        src = np.frombuffer(data, dtype='>u2').reshape(self.height, self.width)
+        np.copyto(self.rgb565, src[::-1])
+        packed = self.rgb565.view(np.uint8).reshape(self.height, self.width, 2)
+        return cv2.cvtColor(packed, cv2.COLOR_BGR5652BGRA, dst=self.image)
+
+    def mon_to_mat(self, data):
+        if self.pixel_bytes != 2:
+            return np.frombuffer(data, np.uint8).reshape(self.height, self.width, 1)
+        src = np.frombuffer(data, dtype=np.uint16).reshape(self.height, self.width, 1)
+        if self.lut is not None:
+            return np.take(self.lut, src, out=self.gray, mode='clip')
+        # Shift in uint16 and narrow straight into the output, without a full-size temporary
+        np.right_shift(src, self.bit_width - 8, out=self.gray, casting='unsafe')
+        return self.gray
+
+    def separate(self, data):
+        # High bytes fill the left half and low bytes the right, narrowed directly into the output
+        w = self.width
+        src = np.frombuffer(data, dtype=np.uint16).reshape(self.height, w)
+        np.right_shift(src, 8, out=self.gray[:, :w, 0], casting='unsafe')
+        np.copyto(self.gray[:, w:, 0], src, casting='unsafe')
+        return self.gray
+
+    def apply_color(self, image):
+        if self.color_code is None:
+            return image
+        return cv2.cvtColor(image, self.color_code, dst=self.image)
@@ -0,0 +1,208 @@
+import logging
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds - from a fast transform up to a slow upload
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metric():
+    """
+    A named family of values, one per combination of label values. Values are either updated as
+    things happen or read from a function at scrape time - the latter for anything the pipeline
+    already keeps count of, so it costs nothing until someone asks.
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self.new_child())
+        return child
+
+    def new_child(self):
+        return Value()
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.help), "# TYPE {0} {1}".format(self.name, self.kind)]
+        for key, child in list(self.children.items()):
+            labels = dict(zip(self.label_names, key))
+            lines.extend(child.render(self.name, labels))
+        return lines
+
+
+class Value():
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def get(self):
+        if self.function is None:
+            return self.value
+        try:
+            return self.function()
+        except Exception:
+            return None
+
+    def render(self, name, labels):
+        value = self.get()
+        if value is None:
+            return []
+        return ["{0}{1} {2}".format(name, format_labels(labels), format_value(value))]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, help, labels)
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+
+class HistogramValue():
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count per bucket plus one for everything above the largest
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def render(self, name, labels):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append("{0}_bucket{1} {2}".format(
+                name, format_labels(dict(labels, le=format_value(bound))), cumulative))
+        lines.append("{0}_sum{1} {2}".format(name, format_labels(labels), format_value(total)))
+        lines.append("{0}_count{1} {2}".format(name, format_labels(labels), cumulative))
+        return lines
+
+
+class Registry():
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get(self, cls, name, help, labels=(), **kwargs):
+        # Several cameras in one process register the same metrics - they share one family
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labels, **kwargs)
+            elif not isinstance(metric, cls) or metric.label_names != tuple(labels):
+                raise ValueError("Metric {} is already registered with a different type or labels".format(name))
+            return metric
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=()):
+    return REGISTRY.get(Counter, name, help, labels)
+
+
+def gauge(name, help, labels=()):
+    return REGISTRY.get(Gauge, name, help, labels)
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.get(Histogram, name, help, labels, buckets=buckets)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(k, escape(v)) for k, v in labels.items()) + "}"
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def serve(port, registry=REGISTRY):
+    """
+    Serves the registry in Prometheus text format on http://0.0.0.0:port/metrics
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.rstrip('/') != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.getLogger("metrics").info("Serving metrics on http://0.0.0.0:{}/metrics".format(port))
+    return server
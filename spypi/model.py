@@ -1,15 +1,47 @@
+import asyncio
 import io
+import json
 import logging
+import math
 import os
-from collections import deque
+import threading
+import time
+import uuid
+from collections import deque, OrderedDict
 from datetime import datetime
 from os.path import join
 
 import cv2
 import imutils
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from spypi.utils import MultiCounter, ddrate
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from turbojpeg import TurboJPEG
+except ImportError:
+    TurboJPEG = None
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from spypi import metrics
+from spypi.encoder import Segmenter, get_writer_class
+from spypi.error import EncoderException
+from spypi.utils import MultiCounter, DropQueue, TokenBucket, PacedBody, ddrate, start_thread, file_checksum
+
+POST_SECONDS = metrics.histogram('spypi_post_seconds', "Time to post an image, video or video chunk",
+                                 ['camera', 'kind'])
+POST_BYTES = metrics.counter('spypi_post_bytes_total', "Bytes posted", ['camera', 'kind'])
+JPEG_SECONDS = metrics.histogram('spypi_jpeg_encode_seconds', "Time to encode a posted image", ['camera'])
+VIDEO_ENCODE_SECONDS = metrics.histogram('spypi_video_encode_seconds', "Time to encode a recorded frame",
+                                         ['camera'])
+VIDEO_FILES = metrics.counter('spypi_video_files_total', "Recordings finished", ['camera'])
+VIDEO_BYTES = metrics.counter('spypi_video_bytes_total', "Bytes in finished recordings", ['camera'])
 
 
 class ImageManip():
@@ -69,13 +101,274 @@ class ImageManip():
         return image[top:h - bottom, left:w - right, :]
 
 
+class TransformPipeline():
+    """
+    Equivalent of ImageManip crop -> resize -> rotate, with the geometry worked out once per input
+    shape and applied in a single pass (copy, resize, cv2.rotate or one warpAffine) into a pool of
+    reused output buffers. 'keep_size' matches rotate(resize=True).
+
+    Each output is leased until release() is called with it, so whoever consumes the frame last -
+    an encoder, a writer or a queue dropping it - has to hand it back. Outputs never released are
+    simply not reused.
+    """
+
+    MAX_BUFFERS = 16
+
+    ROTATE_CODES = {
+        90: cv2.ROTATE_90_CLOCKWISE,
+        180: cv2.ROTATE_180,
+        270: cv2.ROTATE_90_COUNTERCLOCKWISE,
+    }
+
+    def __init__(self, crop=None, size=None, rotation=0, keep_size=False, buffers=2):
+        if size and min(size) <= 0:
+            raise ValueError("Dimensions must be positive")
+        self.crop = crop or [0, 0, 0, 0]
+        self.size = tuple(size) if size else None
+        self.rotation = rotation
+        self.keep_size = keep_size
+        self.buffers = buffers
+        self.output_scale = 1.0
+        self.shape = None
+        self.outputs = []
+        self.leased = []
+        self.lock = threading.Lock()
+        self.window = None
+        self.dsize = None
+        self.matrix = None
+        self.method = None
+
+    def build(self, shape):
+        h, w = shape[:2]
+        top = round(self.crop[0] * 0.01 * h)
+        left = round(self.crop[1] * 0.01 * w)
+        bottom = round(self.crop[2] * 0.01 * h)
+        right = round(self.crop[3] * 0.01 * w)
+        if (w - left - right) <= 0 or (h - top - bottom) <= 0 or min(self.crop) < 0:
+            raise ValueError("Crop dimensions exceed area or are negative")
+        self.window = (slice(top, h - bottom), slice(left, w - right))
+
+        cw, ch = w - left - right, h - top - bottom
+        rw, rh = self.size or (cw, ch)
+        if self.output_scale != 1:
+            rw, rh = max(1, round(rw * self.output_scale)), max(1, round(rh * self.output_scale))
+        scale = self.scale_matrix((cw, ch), (rw, rh))
+        angle = self.rotation % 360
+
+        if angle == 0:
+            self.dsize = (rw, rh)
+            self.method = 'resize' if (rw, rh) != (cw, ch) else 'copy'
+            self.matrix = None
+        else:
+            # Same bounds and matrix as imutils.rotate_bound
+            rot = cv2.getRotationMatrix2D((rw / 2, rh / 2), -self.rotation, 1.0)
+            cos, sin = np.abs(rot[0, 0]), np.abs(rot[0, 1])
+            nw, nh = int((rh * sin) + (rw * cos)), int((rh * cos) + (rw * sin))
+            rot[0, 2] += (nw / 2) - rw / 2
+            rot[1, 2] += (nh / 2) - rh / 2
+            matrix = np.vstack([rot, [0, 0, 1]]) @ scale
+            self.dsize = (nw, nh)
+            if self.keep_size and angle % 180 != 0:
+                matrix = self.scale_matrix((nw, nh), (rw, rh)) @ matrix
+                self.dsize = (rw, rh)
+            self.matrix = matrix[:2]
+            if angle in self.ROTATE_CODES and (rw, rh) == (cw, ch) \
+                    and self.dsize == ((rh, rw) if angle % 180 else (rw, rh)):
+                # Quarter turns are a plain pixel shuffle - no interpolation needed
+                self.method = 'rotate'
+            else:
+                self.method = 'warp'
+
+        self.out_shape = (self.dsize[1], self.dsize[0]) + tuple(shape[2:])
+        with self.lock:
+            # Outputs of the old shape still out on lease are dropped when they come back
+            self.outputs = [np.empty(self.out_shape, dtype=np.uint8) for _ in range(max(self.buffers, 1))]
+            self.leased = []
+        self.shape = shape
+
+    def set_output_scale(self, scale):
+        # Shrinks the output on top of 'size' - geometry is rebuilt on the next frame
+        if scale != self.output_scale:
+            self.output_scale = scale
+            self.shape = None
+
+    def get_output(self):
+        with self.lock:
+            for out in self.outputs:
+                if not any(out is leased for leased in self.leased):
+                    self.leased.append(out)
+                    return out
+            out = np.empty(self.out_shape, dtype=np.uint8)
+            if len(self.outputs) < self.MAX_BUFFERS:
+                self.outputs.append(out)
+                self.leased.append(out)
+            return out
+
+    def release(self, out):
+        """
+        Returns an output to the pool - it must not be used after this
+        """
+        with self.lock:
+            for i, leased in enumerate(self.leased):
+                if leased is out:
+                    del self.leased[i]
+                    return
+
+    @staticmethod
+    def scale_matrix(src, dst):
+        # Pixel-centre mapping used by cv2.resize
+        sx, sy = dst[0] / src[0], dst[1] / src[1]
+        return np.array([[sx, 0, 0.5 * (sx - 1)], [0, sy, 0.5 * (sy - 1)], [0, 0, 1]])
+
+    def __call__(self, image):
+        if image.shape != self.shape:
+            self.build(image.shape)
+        out = self.get_output()
+        src = image[self.window]
+
+        if self.method == 'copy':
+            np.copyto(out, src)
+        elif self.method == 'resize':
+            cv2.resize(src, self.dsize, dst=out)
+        elif self.method == 'rotate':
+            cv2.rotate(src, self.ROTATE_CODES[self.rotation % 360], dst=out)
+        else:
+            cv2.warpAffine(src, self.matrix, self.dsize, dst=out)
+        return out
+
+
+class DataBar():
+    """
+    Draws the same black bar and label text as ImageManip.rectangle + add_label, but from cached sprites:
+    each character is rendered once, lines are composed from those glyphs and the most recent
+    'max_lines' distinct lines are kept. Glyphs land on whole pixels, so anti-aliasing can differ
+    very slightly from putText; blending with max() is otherwise exact on the black bar.
+    Sprites are cached per channel layout, so grayscale (e.g. arducam MON) frames work as well.
+    """
+
+    FONT = cv2.FONT_HERSHEY_DUPLEX
+
+    def __init__(self, scale, padding, color=(255, 255, 255), max_lines=32):
+        self.scale = scale
+        self.padding = padding
+        self.color = color
+        self.max_lines = max_lines
+        ((_, self.text_height), _) = cv2.getTextSize('XXX', self.FONT, scale, 1)
+        ((_, self.ascent), self.descent) = cv2.getTextSize('Xgjy|()[]', self.FONT, scale, 1)
+        self.margin = 2 + math.ceil(scale)
+        self.glyphs = {}
+        self.lines = OrderedDict()
+        self.previous = None
+
+    def clear(self):
+        self.glyphs.clear()
+        self.lines.clear()
+        self.previous = None
+
+    def get_height(self, count):
+        return self.text_height * count + (count + 1) * self.padding
+
+    @staticmethod
+    def get_channels(image):
+        # None for a 2-D grayscale frame, otherwise the size of its channel axis
+        return image.shape[2] if image.ndim == 3 else None
+
+    def new_sprite(self, width, channels):
+        shape = (self.ascent + self.descent + 2 * self.margin, width)
+        return np.zeros(shape if channels is None else shape + (channels,), dtype=np.uint8)
+
+    def get_glyph(self, char, channels=3):
+        glyph = self.glyphs.get((char, channels))
+        if glyph is None:
+            if len(self.glyphs) > 256:
+                self.glyphs.clear()
+            ((w, _), _) = cv2.getTextSize(char, self.FONT, self.scale, 1)
+            # Hershey advances aren't whole pixels, so measure a long run to get it precisely
+            advance = (cv2.getTextSize(char * 65, self.FONT, self.scale, 1)[0][0] - w) / 64
+            m = self.margin
+            sprite = self.new_sprite(w + 2 * m, channels)
+            cv2.putText(sprite, char, (m, m + self.ascent), self.FONT, self.scale, self.color, 1, cv2.LINE_AA)
+            glyph = self.glyphs[(char, channels)] = (sprite, advance)
+        return glyph
+
+    def get_line(self, text, channels=3):
+        key = (text, channels)
+        sprite = self.lines.get(key)
+        if sprite is not None:
+            self.lines.move_to_end(key)
+            return sprite
+
+        glyphs = [self.get_glyph(c, channels) for c in text]
+        lefts = []
+        x = 0.0
+        for _, advance in glyphs:
+            lefts.append(round(x))
+            x += advance
+        width = math.ceil(x) + max((g[0].shape[1] for g in glyphs), default=0)
+        sprite = self.new_sprite(width, channels)
+
+        # Successive timestamps share most of their text, so reuse the columns of the previous line
+        # up to the first changed glyph and only re-blend from there (max() is idempotent)
+        start = 0
+        if self.previous is not None and self.previous[0][1] == channels:
+            (prev_text, _), prev_sprite = self.previous
+            n = 0
+            while n < min(len(text), len(prev_text)) and text[n] == prev_text[n]:
+                n += 1
+            if n:
+                cut = min(lefts[n] if n < len(text) else round(x), prev_sprite.shape[1])
+                sprite[:, :cut] = prev_sprite[:, :cut]
+                start = n
+                while start > 0 and lefts[start - 1] + glyphs[start - 1][0].shape[1] > cut:
+                    start -= 1
+
+        for (glyph, _), left in zip(glyphs[start:], lefts[start:]):
+            region = sprite[:, left:left + glyph.shape[1]]
+            cv2.max(region, glyph, dst=region)
+
+        self.previous = (key, sprite)
+        self.lines[key] = sprite
+        if len(self.lines) > self.max_lines:
+            self.lines.popitem(last=False)
+        return sprite
+
+    def draw(self, image, text):
+        h, w = image.shape[:2]
+        channels = self.get_channels(image)
+        image[max(h - self.get_height(len(text)), 0):, :] = 0
+
+        y = h - self.padding
+        for line in reversed(text):
+            sprite = self.get_line(line, channels)
+            top = y - self.ascent - self.margin
+            left = self.padding - self.margin
+            # Clip the sprite to the image
+            st, sl = max(-top, 0), max(-left, 0)
+            bottom, right = min(top + sprite.shape[0], h), min(left + sprite.shape[1], w)
+            if bottom > top + st and right > left + sl:
+                region = image[top + st:bottom, left + sl:right]
+                cv2.max(region, sprite[st:st + region.shape[0], sl:sl + region.shape[1]], dst=region)
+            y = y - (self.text_height + self.padding)
+        return image
+
+
 class VideoStream():
+    """
+    Writes frames to size- and/or duration-capped video files on its own thread so encoding never
+    blocks the video stream_process. The next file is opened ahead of the rollover and the finished
+    one is closed in the background, so a rollover costs no more than a single frame write.
+    """
+
+    PREOPEN_AT = 0.9
+    STAT_INTERVAL = 1
 
     def __init__(self, filename_prefix=None, directory=None, max_file_size=0, resolution=None,
-                 fps=20, log_metrics=False):
+                 fps=20, log_metrics=False, queue_size=8, encoder=None, max_duration=0, align_keyframes=True):
         self.filename_prefix = filename_prefix
+        self.encoder = encoder or {'backend': 'opencv'}
+        self.writer_class = get_writer_class(self.encoder['backend'])
+        self.extension = self.writer_class.get_extension(self.encoder)
         self.directory = directory or os.getcwd()
-        self.frames = []
         self.size = 0
         self.disk_size = 0
         self.max_file_size = max_file_size
@@ -84,79 +377,651 @@ class VideoStream():
         self.logger = logging.getLogger("video")
         self.fps = fps
         self.log_metrics = log_metrics
-        self.output_counter = MultiCounter(20)
+        self.segmenter = Segmenter(max_file_size, max_duration, align_keyframes)
+        self.stat_size = 0
+        self.stat_time = 0
         os.makedirs(self.directory, exist_ok=True)
         self.writer = None
+        self.filename = None
+        self.next_writer = None
         self.data_rate = MultiCounter(5)
         self.sizes = deque(maxlen=7)
         self.cx = 0
+        self.listeners = []
+        self.queue = DropQueue(queue_size)
+        self.encode_times = deque(maxlen=100)
+        self.encode_seconds = VIDEO_ENCODE_SECONDS.labels(camera=filename_prefix)
+        self.metrics_counter = MultiCounter(100)
+        self.running = False
+        self.thread = None
+        self.segment = 0
+        self.writer_segment = 0
+        self.ended_segment = -1
+        self.jpeg = JpegEncoder()
+        self.register_metrics()
 
-    def get_filename(self, extension="avi"):
-        return join(self.directory, "LOCKED-{0}-{1}.{2}".format(
-            self.filename_prefix, datetime.now().strftime("%Y-%m-%d_%H-%M-%S"), extension))
+    def register_metrics(self):
+        labels = dict(camera=self.filename_prefix)
+        metrics.gauge('spypi_video_queue_depth', "Frames waiting for the video writer", ['camera']) \
+            .labels(**labels).set_function(lambda: len(self.queue))
+        metrics.counter('spypi_video_queue_dropped_total', "Frames dropped by a full video writer queue",
+                        ['camera']).labels(**labels).set_function(lambda: self.queue.dropped)
 
-    def get_filesize(self, filename):
-        return round(os.stat(filename).st_size * 1e-6, 2)
+    def get_filename(self, extension=None):
+        extension = extension or self.extension
+        name = "{0}-{1}".format(self.filename_prefix, datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
+        # Rollovers less than a second apart (or a pre-opened next file) would otherwise collide
+        taken = {self.filename, self.next_writer[0] if self.next_writer else None}
+        filename, count = join(self.directory, "LOCKED-{0}.{1}".format(name, extension)), 1
+        while filename in taken or os.path.exists(filename) or os.path.exists(filename.replace("LOCKED-", "")):
+            filename = join(self.directory, "LOCKED-{0}-{1}.{2}".format(name, count, extension))
+            count += 1
+        return filename
 
     def get_writer(self):
-        self.filename = self.get_filename()
-        return cv2.VideoWriter(self.filename, cv2.VideoWriter_fourcc('X', 'V', 'I', 'D'), self.fps, self.resolution)
+        filename = self.get_filename()
+        return filename, self.writer_class(filename, self.resolution, self.fps, self.encoder)
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.thread = start_thread(self.write_frames)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.writer is not None:
+            if self.writer.frames:
+                self.close_file(self.writer, self.filename)
+            else:
+                self.discard_file(self.writer, self.filename)
+            self.writer = None
+        if self.next_writer is not None:
+            self.discard_file(*reversed(self.next_writer))
+            self.next_writer = None
+
+    @staticmethod
+    def discard_file(writer, filename):
+        writer.release()
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+    def add_frame(self, frame, trace=None, release=None):
+        """
+        The frame is written later by the writer thread, so callers must not modify it afterwards
+        :param release: called with the frame once it is written or dropped
+        """
+        self.start()
+        dropped = self.queue.put((self.segment, frame, trace, release))
+        if dropped is not None:
+            _, frame, _, release = dropped
+            if release is not None:
+                release(frame)
+
+    def add_encoded(self, frames):
+        """
+        Queue JPEG-encoded frames (e.g. an event pre-roll) as a single item, decoded on the writer thread
+        """
+        self.start()
+        self.queue.put((self.segment, list(frames), None, None))
+
+    def new_segment(self):
+        # Frames added from now on go to a new file
+        self.segment += 1
 
-    def add_frame(self, frame):
+    def end_segment(self):
+        # Close the current file once the frames already queued are written
+        self.ended_segment = self.segment
+
+    def write_frames(self):
+        # Drain whatever is queued before stopping
+        while self.running or len(self.queue):
+            item = self.queue.get(timeout=1)
+            if item is None:
+                if self.writer is not None and self.writer_segment == self.ended_segment:
+                    self.end_file()
+                continue
+            segment, frames, trace, release = item
+            item = None
+            try:
+                self.write_item(segment, frames, trace, release)
+            except Exception as e:
+                # Anything the backends don't wrap (av or cv2 errors, a failed open or stat) would
+                # otherwise end this thread and recording with it
+                self.logger.exception("Video writer error, continuing in a new file: {}".format(e))
+                self.reset_file()
+            frames = trace = release = None
+
+    def write_item(self, segment, frames, trace, release):
+        if self.writer is not None and segment != self.writer_segment:
+            self.end_file()
         if self.writer is None:
-            self.writer = self.get_writer()
-        self.writer.write(frame)
-        if self.output_counter.increment():
-            self.disk_size = self.get_filesize(self.filename)
-            if round(self.disk_size) >= self.max_file_size:
-                if self.log_metrics:
-                    self.cx += 1
-                    self.data_rate.increment()
-                    self.sizes.append(self.disk_size)
-                    self.logger.debug(
-                        "Data rate: {0} GB/day // count: {1}"
-                            .format(ddrate(self.data_rate.get_rate(), self.sizes), self.cx))
-                self.start_new_file()
-                self.logger.debug(
-                    "Max size exceeded ({0}). Start new file: {1}".format(self.disk_size, self.filename))
+            self.filename, self.writer = self.get_writer()
+            self.writer_segment = segment
+            self.segmenter.start()
+        if isinstance(frames, list):
+            for encoded in frames:
+                self.write_frame(self.jpeg.decode(encoded))
+        else:
+            if trace is not None:
+                trace.mark('queue')
+            try:
+                self.write_frame(frames)
+            finally:
+                if release is not None:
+                    release(frames)
+            if trace is not None:
+                trace.mark('encode')
+                trace.finish()
+
+    def write_frame(self, frame):
+        start = time.perf_counter()
+        try:
+            self.writer.write(frame)
+        except EncoderException as e:
+            # Keep what made it into the file and carry on in a new one
+            self.logger.error(e)
+            self.start_new_file()
+            return
+        elapsed = time.perf_counter() - start
+        self.encode_times.append(elapsed)
+        self.encode_seconds.observe(elapsed)
+        self.check_segment()
+        if self.log_metrics and self.metrics_counter.increment():
+            self.logger.debug("Writer queue: {0}/{1} // encode: {2} ms // dropped: {3}".format(
+                len(self.queue), self.queue.items.maxlen,
+                round(1000 * sum(self.encode_times) / len(self.encode_times), 2), self.queue.dropped))
+
+    def end_file(self):
+        start_thread(self.close_file, writer=self.writer, filename=self.filename)
+        self.writer = None
+        if self.next_writer is not None:
+            # Named for when it was opened - the next segment gets a fresh one
+            self.discard_file(*reversed(self.next_writer))
+            self.next_writer = None
+
+    def reset_file(self):
+        # The writers' state is unknown after an error - keep what they have and open new ones as needed
+        writer, filename, next_writer = self.writer, self.filename, self.next_writer
+        self.writer = self.next_writer = None
+        self.stat_size = 0
+        if writer is not None:
+            start_thread(self.close_file, writer=writer, filename=filename)
+        if next_writer is not None:
+            start_thread(self.close_file, writer=next_writer[1], filename=next_writer[0], discard=True)
+
+    def get_bytes_written(self):
+        if self.writer.bytes_written is not None:
+            return self.writer.bytes_written
+        # OpenCV doesn't report its output size, so stat at most once every STAT_INTERVAL seconds instead
+        now = time.monotonic()
+        if now - self.stat_time >= self.STAT_INTERVAL:
+            self.stat_size = os.stat(self.filename).st_size
+            self.stat_time = now
+        return self.stat_size
+
+    def check_segment(self):
+        size = self.get_bytes_written()
+        progress = self.segmenter.progress(size)
+        if self.next_writer is None and progress >= self.PREOPEN_AT:
+            self.next_writer = self.get_writer()
+        if progress < 1 or (self.segmenter.align_keyframes and not self.writer.next_is_keyframe()):
+            return
+        self.disk_size = round(size * 1e-6, 2)
+        if self.log_metrics:
+            self.cx += 1
+            self.data_rate.increment()
+            self.sizes.append(self.disk_size)
+            self.logger.debug(
+                "Data rate: {0} GB/day // count: {1}"
+                    .format(ddrate(self.data_rate.get_rate(), self.sizes), self.cx))
+        self.start_new_file()
+        self.logger.debug(
+            "Segment limit reached ({0} MB). Start new file: {1}".format(self.disk_size, self.filename))
 
     def start_new_file(self):
-        self.writer.release()
-        os.rename(self.filename, self.filename.replace("LOCKED-", ""))
-        self.writer = self.get_writer()
+        writer, filename = self.writer, self.filename
+        self.filename, self.writer = self.next_writer or self.get_writer()
+        self.next_writer = None
+        self.stat_size = 0
+        self.segmenter.start()
+        start_thread(self.close_file, writer=writer, filename=filename)
+
+    def close_file(self, writer, filename, discard=False):
+        # Runs on a thread of its own, so errors are logged here rather than lost
+        try:
+            if discard:
+                self.discard_file(writer, filename)
+            else:
+                writer.release()
+                self.finish_file(filename)
+        except Exception as e:
+            self.logger.error("Unable to close {0}: {1}".format(filename, e))
+
+    def finish_file(self, filename):
+        """
+        Unlocks a finished recording and hands it to the listeners (e.g. the uploader)
+        """
+        finished = filename.replace("LOCKED-", "")
+        os.rename(filename, finished)
+        VIDEO_FILES.labels(camera=self.filename_prefix).inc()
+        VIDEO_BYTES.labels(camera=self.filename_prefix).inc(os.stat(finished).st_size)
+        for listener in self.listeners:
+            listener(finished)
+        return finished
+
+
+class JpegEncoder():
+
+    def __init__(self, quality=95):
+        self.logger = logging.getLogger("encoder")
+        self.quality = quality
+        self.turbo = None
+        if TurboJPEG is not None:
+            try:
+                self.turbo = TurboJPEG()
+                self.logger.info("Using libjpeg-turbo for JPEG encoding")
+            except Exception as e:
+                self.logger.warning("Unable to load libjpeg-turbo, falling back to OpenCV: {}".format(e))
+
+    def encode(self, image):
+        if self.turbo is not None:
+            return self.turbo.encode(image, quality=self.quality)
+        return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])[1]
+
+    def decode(self, data):
+        if self.turbo is not None:
+            return self.turbo.decode(data)
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
 
 
-class Connector:
+class ImageChannel():
+    """
+    Where one camera's images are posted - its URL, JPEG quality and post latency
+    """
+
+    def __init__(self, host, name, quality):
+        self.name = name
+        self.image_url = "{0}/cameras/{1}/update".format(host, name)
+        self.encoder = JpegEncoder(quality)
+        self.latency = {'image': deque(maxlen=50), 'video': deque(maxlen=10)}
+        self.post_counter = MultiCounter(50)
+        self.log_metrics = False
+        self.post_seconds = {kind: POST_SECONDS.labels(camera=name, kind=kind) for kind in self.latency}
+        self.post_bytes = {kind: POST_BYTES.labels(camera=name, kind=kind) for kind in self.latency}
+        self.encode_seconds = JPEG_SECONDS.labels(camera=name)
+
+    def encode(self, image):
+        start = time.perf_counter()
+        data = self.encoder.encode(image)
+        self.encode_seconds.observe(time.perf_counter() - start)
+        self.post_bytes['image'].inc(len(data))
+        return data
+
+    def get_latency(self, kind='image'):
+        values = list(self.latency[kind])
+        return sum(values) / len(values) if values else 0
+
+    def record_latency(self, kind, start):
+        elapsed = time.perf_counter() - start
+        self.latency[kind].append(elapsed)
+        self.post_seconds[kind].observe(elapsed)
+        if self.log_metrics and kind == 'image' and self.post_counter.increment():
+            self.logger.debug("Connector // post rate: {0} // image latency: {1} ms"
+                              .format(self.post_counter.get_rate(2), round(1000 * self.get_latency('image'), 1)))
+
+
+class Connector(ImageChannel):
 
     def __init__(self, config):
+        super(Connector, self).__init__(config['host'], config['name'], config['jpeg_quality'])
         self.logger = logging.getLogger("connector")
         self.host = config['host']
-        self.name = config['name']
         self.timeout = config['timeout']
-        self.image_url = "{0}/cameras/{1}/update".format(self.host, self.name)
+        self.image_timeout = config['image_timeout'] or self.timeout
+        self.video_timeout = config['video_timeout'] or self.timeout
         self.video_url = "{0}/store".format(self.host)
+        self.video_chunk_url = "{0}/store/chunk".format(self.host)
+        self.chunk_size = int(config['chunk_size'] * 1e6)
+        # Only video uploads are throttled, so a backlog can't starve the live images
+        self.bandwidth = TokenBucket(config['upload_rate_limit'] * 1e3, max(self.chunk_size, 1 << 20))
+        self.session = self.get_session(config['pool_size'], config['retries'], config['retry_backoff'])
+        self.running = True
+        self.start_workers(config)
+        self.register_metrics()
+
+    def register_metrics(self):
+        labels = dict(connector=self.name)
+        metrics.gauge('spypi_post_queue_depth', "Images waiting to be encoded and posted", ['connector']) \
+            .labels(**labels).set_function(self.get_queue_depth)
+        metrics.counter('spypi_post_queue_dropped_total', "Images dropped by a full post queue", ['connector']) \
+            .labels(**labels).set_function(self.get_dropped)
 
-    def send_image(self, image):
+    @classmethod
+    def create(cls, config):
+        mode = config['mode']
+        if mode == 'sync':
+            return Connector(config)
+        elif mode == 'async':
+            return AsyncConnector(config)
+
+        raise ValueError("Unknown connection mode: {}".format(mode))
+
+    def start_workers(self, config):
+        self.image_queue = DropQueue(config['encode_queue'])
+        for _ in range(config['encode_workers']):
+            start_thread(self.image_worker)
+
+    def camera(self, name):
+        """
+        Connector for another camera posting as 'name' over this one's session and workers
+        """
+        return CameraConnector(self, name)
+
+    def send_image(self, image, trace=None, release=None):
+        """
+        :param release: called with the image once it is encoded or dropped
+        """
+        self.queue_image(self, image, trace, release)
+
+    def queue_image(self, channel, image, trace=None, release=None):
+        # Encoding and posting happen on the worker pool; when it falls behind the oldest frame is dropped
+        dropped = self.image_queue.put((channel, image, trace, release))
+        if dropped is not None:
+            _, image, _, release = dropped
+            if release is not None:
+                release(image)
+
+    def stop(self):
+        self.running = False
+        self.session.close()
+
+    def get_queue_depth(self):
+        return len(self.image_queue)
+
+    def get_dropped(self):
+        return self.image_queue.dropped
+
+    def image_worker(self):
+        while self.running:
+            item = self.image_queue.get(timeout=1)
+            if item is None:
+                continue
+            channel, image, trace, release = item
+            try:
+                if trace is not None:
+                    trace.mark('queue')
+                try:
+                    file = io.BytesIO(channel.encode(image))
+                finally:
+                    # Hand the frame back before the upload so its buffer can be reused
+                    if release is not None:
+                        release(image)
+                item = image = None
+                if trace is not None:
+                    trace.mark('encode')
+                self.send_files(url=channel.image_url, files=dict(file=file), headers={},
+                                timeout=self.image_timeout, kind='image', channel=channel)
+                if trace is not None:
+                    trace.mark('post')
+                    trace.finish()
+            except Exception as e:
+                self.logger.error(e)
+
+    @staticmethod
+    def get_session(pool_size, retries, backoff):
+        # One keep-alive session for every post, instead of a new connection per frame
+        retry_args = dict(total=retries, backoff_factor=backoff, status_forcelist=(502, 503, 504),
+                          raise_on_status=False)
         try:
-            file = io.BytesIO(cv2.imencode('.jpg', image)[1])
-            self.send_files(url=self.image_url, files=dict(file=file), headers={})
-        except Exception as e:
-            self.logger.error(e)
+            retry = Retry(allowed_methods=None, **retry_args)
+        except TypeError:
+            # urllib3 < 1.26
+            retry = Retry(method_whitelist=False, **retry_args)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
 
     def send_video(self, path):
         try:
-            filesize = round(os.stat(path).st_size * 1e-6, 2)
-            headers = {'Size': str(filesize)}
-            file = open(path, 'rb')
+            if self.chunk_size:
+                return self.send_video_chunks(path)
+            size = os.stat(path).st_size
+            filesize = round(size * 1e-6, 2)
+            headers = {'Size': str(filesize), 'Checksum': "sha256={}".format(file_checksum(path))}
             self.logger.debug("Sending video {0} ({1} MB)".format(path, filesize))
-            return self.send_files(url=self.video_url, files=dict(file=file), headers=headers)
+            self.post_bytes['video'].inc(size)
+            with open(path, 'rb') as file:
+                # The same form requests builds from files=, but streamed from disk at the upload rate
+                boundary = uuid.uuid4().hex
+                head = ('--{0}\r\nContent-Disposition: form-data; name="file"; filename="{1}"\r\n\r\n'
+                        .format(boundary, os.path.basename(path))).encode()
+                tail = '\r\n--{}--\r\n'.format(boundary).encode()
+                headers['Content-Type'] = 'multipart/form-data; boundary={}'.format(boundary)
+                return self.send_files(url=self.video_url, data=PacedBody(self.bandwidth, head, file, tail),
+                                       headers=headers, timeout=self.video_timeout, kind='video')
         except Exception as e:
             self.logger.error(e)
 
-    def send_files(self, url, files, headers=None, timeout=None):
+    def send_video_chunks(self, path):
+        """
+        Streams the file in chunk_size pieces, resuming from the offset the server last acknowledged.
+        The server replies to each chunk with {"offset": next expected byte, "complete": bool} and
+        only marks the upload complete once the whole file matches Upload-Checksum. An offset that
+        doesn't move forward, or lies outside the file, ends the attempt rather than resending forever.
+        :return: True once the server has confirmed the complete file
+        """
+        size = os.stat(path).st_size
+        state = self.load_upload_state(path)
+        if state is None or state['size'] != size or not 0 <= state['offset'] <= size:
+            state = {'size': size, 'offset': 0, 'checksum': file_checksum(path)}
+        headers = {
+            'Upload-Name': os.path.basename(path),
+            'Upload-Length': str(size),
+            'Upload-Checksum': "sha256={}".format(state['checksum']),
+        }
+        if state['offset']:
+            self.logger.debug("Resuming video {0} at {1} of {2} bytes".format(path, state['offset'], size))
+        else:
+            self.logger.debug("Sending video {0} ({1} MB) in chunks".format(path, round(size * 1e-6, 2)))
+
+        with open(path, 'rb') as f:
+            while True:
+                f.seek(state['offset'])
+                chunk = f.read(self.chunk_size)
+                self.post_bytes['video'].inc(len(chunk))
+                headers['Upload-Offset'] = str(state['offset'])
+                start = time.perf_counter()
+                r = self.session.post(url=self.video_chunk_url, data=PacedBody(self.bandwidth, chunk),
+                                      headers=headers, timeout=self.video_timeout)
+                self.record_latency('video', start)
+
+                if r.status_code == 409:
+                    # Server rejected the assembled file - start over from scratch next time
+                    self.logger.error("Upload of {0} rejected: {1}".format(path, r.content))
+                    self.clear_upload_state(path)
+                    return False
+                if r.status_code != 200:
+                    self.logger.error("Upload of {0} failed with {1}: {2}".format(path, r.status_code, r.content))
+                    return False
+
+                result = r.json()
+                if result.get('complete'):
+                    self.clear_upload_state(path)
+                    return True
+                if not chunk:
+                    self.logger.error("Server did not confirm upload of {}".format(path))
+                    return False
+                offset = int(result['offset'])
+                if not state['offset'] < offset <= size:
+                    # Keep the last good offset - the next attempt resumes from there
+                    self.logger.error("Upload of {0} stalled: server sent offset {1} after {2} of {3} bytes"
+                                      .format(path, offset, state['offset'], size))
+                    return False
+                state['offset'] = offset
+                self.save_upload_state(path, state)
+
+    @staticmethod
+    def get_upload_state_path(path):
+        return path + ".upload"
+
+    def load_upload_state(self, path):
+        try:
+            with open(self.get_upload_state_path(path)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_upload_state(self, path, state):
+        tmp = self.get_upload_state_path(path) + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.get_upload_state_path(path))
+
+    def clear_upload_state(self, path):
+        try:
+            os.unlink(self.get_upload_state_path(path))
+        except FileNotFoundError:
+            pass
+
+    def send_files(self, url, files=None, headers=None, timeout=None, kind='image', channel=None, data=None):
         headers = headers or {}
         timeout = timeout or self.timeout
-        r = requests.post(url=url, files=files, headers=headers, timeout=timeout)
+        start = time.perf_counter()
+        r = self.session.post(url=url, files=files, data=data, headers=headers, timeout=timeout)
+        (channel or self).record_latency(kind, start)
         if r.status_code != 200:
             self.logger.error(r.content)
+            return False
         return True
+
+
+class CameraConnector(ImageChannel):
+    """
+    One camera's view of a Connector shared by several. Images are posted to this camera's URL
+    with its own JPEG quality and latency, but through the parent's session, queue and workers.
+    Videos are uploaded by the parent, which also owns the video latency.
+    """
+
+    def __init__(self, parent, name):
+        super(CameraConnector, self).__init__(parent.host, name, parent.encoder.quality)
+        self.logger = logging.getLogger("connector.{}".format(name))
+        self.parent = parent
+        self.log_metrics = parent.log_metrics
+        self.latency['video'] = parent.latency['video']
+
+    def send_image(self, image, trace=None, release=None):
+        self.parent.queue_image(self, image, trace, release)
+
+    def send_video(self, path):
+        return self.parent.send_video(path)
+
+    def stop(self):
+        # The session belongs to the parent, which is stopped by whoever created it
+        pass
+
+
+class AsyncConnector(Connector):
+    """
+    Posts images from a single asyncio loop with up to 'max_in_flight' requests pipelined over
+    kept-alive connections, instead of one blocking post per worker thread. Encoding still runs
+    on 'encode_workers' threads. Videos go through the synchronous session as before.
+    """
+
+    def start_workers(self, config):
+        if aiohttp is None:
+            raise ImportError("aiohttp is required for the async connection mode")
+        self.max_in_flight = config['max_in_flight']
+        self.queue_size = config['encode_queue']
+        self.encode_pool = ThreadPoolExecutor(max_workers=config['encode_workers'])
+        self.loop = asyncio.new_event_loop()
+        self.image_queue = None
+        self.senders = None
+        self.dropped = 0
+        start_thread(self.run_loop)
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.image_queue = asyncio.Queue(self.queue_size)
+        try:
+            self.loop.run_until_complete(self.stream_images())
+        except asyncio.CancelledError:
+            pass
+        finally:
+            while not self.image_queue.empty():
+                _, image, _, release = self.image_queue.get_nowait()
+                if release is not None:
+                    release(image)
+            self.encode_pool.shutdown(wait=False)
+            self.loop.close()
+
+    def stop(self):
+        super(AsyncConnector, self).stop()
+        try:
+            self.loop.call_soon_threadsafe(lambda: self.senders and self.senders.cancel())
+        except RuntimeError:
+            # Already stopped - the loop is closed once run_loop exits
+            pass
+
+    def get_queue_depth(self):
+        return self.image_queue.qsize() if self.image_queue is not None else 0
+
+    def get_dropped(self):
+        return self.dropped
+
+    def queue_image(self, channel, image, trace=None, release=None):
+        try:
+            self.loop.call_soon_threadsafe(self.enqueue, channel, image, trace, release)
+        except RuntimeError:
+            # The loop is closed once stopped - drop the frame as a full queue would
+            self.dropped += 1
+            if release is not None:
+                release(image)
+
+    def enqueue(self, channel, image, trace, release):
+        # Runs on the loop - same drop-oldest policy as the threaded workers
+        if self.image_queue.full():
+            _, dropped, _, dropped_release = self.image_queue.get_nowait()
+            if dropped_release is not None:
+                dropped_release(dropped)
+            self.dropped += 1
+        self.image_queue.put_nowait((channel, image, trace, release))
+
+    async def stream_images(self):
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+        timeout = aiohttp.ClientTimeout(total=self.image_timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            self.senders = asyncio.gather(*[self.image_sender(session) for _ in range(self.max_in_flight)])
+            await self.senders
+
+    async def image_sender(self, session):
+        while True:
+            channel, image, trace, release = await self.image_queue.get()
+            try:
+                if trace is not None:
+                    trace.mark('queue')
+                try:
+                    data = await self.loop.run_in_executor(self.encode_pool, channel.encode, image)
+                finally:
+                    if release is not None:
+                        release(image)
+                image = None
+                if trace is not None:
+                    trace.mark('encode')
+                form = aiohttp.FormData()
+                form.add_field('file', bytes(data), filename='file', content_type='image/jpeg')
+                start = time.perf_counter()
+                async with session.post(channel.image_url, data=form) as r:
+                    content = await r.read()
+                channel.record_latency('image', start)
+                if trace is not None:
+                    trace.mark('post')
+                    trace.finish()
+                if r.status != 200:
+                    self.logger.error(content)
+            except Exception as e:
+                self.logger.error("{0}: {1}".format(type(e).__name__, e))
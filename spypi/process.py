@@ -1,34 +1,90 @@
-import glob
+import atexit
+import json
 import logging
+import multiprocessing
 import os
+import shutil
+import signal
 import time
-from collections import deque
-from os.path import join
+from contextlib import nullcontext
 
 import cv2
-from simple_pid import PID
 
-from spypi.camera import Camera, PiCamDirect
+from spypi import metrics
+from spypi.adaptive import AdaptiveController
+from spypi.buffer import FrameScheduler, SharedFrameBuffer
+from spypi.camera import Camera, PiCamDirect, ArduCam
 from spypi.error import ImageReadException, ArducamException
-from spypi.model import Connector, VideoStream, ImageManip as im
-from spypi.utils import MultiCounter, start_thread, timestamp
+from spypi.event import EventRecorder
+from spypi.model import Connector, VideoStream, TransformPipeline, DataBar, ImageManip as im
+from spypi.motion import MotionDetector
+from spypi.trace import get_tracer
+from spypi.upload import VideoUploader
+from spypi.utils import MultiCounter, TokenBucket, start_thread, timestamp
+
+STAGE_SECONDS = metrics.histogram('spypi_stage_seconds', "Time to process a frame", ['camera', 'stage'])
+FRAME_AGE = metrics.histogram('spypi_frame_age_seconds', "Time from capture until a stage takes the frame",
+                              ['camera', 'stage'])
+
+
+class SharedMotion():
+    """
+    Stands in for a MotionDetector running in another process
+    """
+
+    def __init__(self, last_motion):
+        self.shared = last_motion
+
+    @property
+    def last_motion(self):
+        return self.shared.value
 
 
 class ImageProcessor():
 
+    # Bytes of camera state shared with the stream processes in multiprocess mode
+    STATE_SIZE = 4096
+
     def __init__(self, config):
         self.config = config
         self.logger = logging.getLogger("processor")
         self.camera = Camera.create(self.config['device'])
+        self.name = self.camera.name = self.config['connection']['name']
+        # Supervisors hand every camera the same bounded pool, a lone camera has it to itself
+        self.workers = nullcontext()
+        self.cpu_budget = TokenBucket(self.config['device']['cpu_budget'])
         processing_config = config['processing']
         self.video_stream = None
         self.connector = None
         self.text_scaling = {}
         self.record_video = processing_config['record_video']
+        self.record_mode = processing_config['record_mode']
+        self.event_preroll = processing_config['event_preroll']
+        self.event_postroll = processing_config['event_postroll']
+        self.event_port = processing_config['event_port']
+        self.event_recorder = None
+        self.adaptive_config = processing_config['adaptive']
+        self.adaptive = None
+        motion_config = processing_config['motion']
+        self.motion = MotionDetector(
+            scale=motion_config['scale'],
+            roi=motion_config['roi'],
+            mask=motion_config['mask'],
+            alpha=motion_config['alpha'],
+            pixel_threshold=motion_config['pixel_threshold'],
+            trigger_score=motion_config['trigger_score'],
+        ) if motion_config['enabled'] else None
         self.recording_directory = processing_config['recording_directory']
         self.send_images = processing_config['send_images']
         self.send_video = processing_config['send_video']
+        self.upload_workers = processing_config['upload_workers']
+        self.upload_order = processing_config['upload_order']
+        self.uploader = None
         self.video_filesize = processing_config['video_filesize']
+        self.video_duration = processing_config['video_duration']
+        self.video_keyframe_split = processing_config['video_keyframe_split']
+        self.video_queue = processing_config['video_queue']
+        self.video_encoder = processing_config['video_encoder']
         self.crop = processing_config['crop']
         self.rotation = processing_config['rotation']
         self.image_size = processing_config['image_size']
@@ -38,155 +94,412 @@ class ImageProcessor():
         }
         self.target_web_framerate = processing_config['target_web_framerate']
         self.target_video_framerate = processing_config['target_video_framerate']
+        self.metrics_config = config['metrics']
+        self.tracer = get_tracer(config['trace'])
+        self.multiprocess = processing_config['multiprocess']
+        self.shared_slots = processing_config['shared_slots']
+        self.processes = {}
+        self.stopping = False
+        self.camera_fps = None
+        # Frames each stream has handled - shared so they can be read from the capture process
+        self.processed = {name: multiprocessing.RawValue('Q', 0) for name in ('web', 'video')}
         self.show_fps = processing_config['show_fps']
-        self.vid_pid = processing_config['video_fr_pid']
-        self.web_pid = processing_config['web_fr_pid']
+        if processing_config.get('video_fr_pid') or processing_config.get('web_fr_pid'):
+            self.logger.warning("video_fr_pid/web_fr_pid are no longer used - "
+                                "streams are paced to their target framerates by capture time")
         self.log_metrics = self.config['logging']['log_metrics']
         self.ignore_warnings = self.camera.ignore_warnings = self.config['logging']['ignore_warnings']
         self.log_extra_info = self.camera.log_extra_info = self.config['logging']['log_extra_info']
         self.camera.log_metrics = self.log_metrics
-        self.camera.capture_image = self.send_images
+        self.camera.capture_image = self.send_images or self.motion is not None
         self.camera.framerate = processing_config['target_video_framerate']
-        self.compute_data_bar_geom()
+        self.web_transform = TransformPipeline(crop=self.crop, size=self.image_size, rotation=self.rotation)
+        self.video_transform = TransformPipeline(rotation=self.rotation, keep_size=True)
+        self.data_bars = {name: DataBar(size[0], size[1]) for name, size in self.data_scaling.items()}
 
-    def run(self):
+    def run(self, connector=None, uploaders=None):
+        """
+        :param connector: shared connector to post through instead of opening one
+        :param uploaders: shared VideoUploaders by (directory, extension), added to as needed
+        """
+        if self.multiprocess:
+            if isinstance(self.camera, PiCamDirect):
+                self.logger.warning("Multiprocess mode is not supported by picam-direct - running threaded")
+            else:
+                return self.run_processes()
 
         self.camera.start()
+        self.register_camera_metrics()
 
         if self.send_video or self.send_images:
-            self.connector = Connector(self.config['connection'])
+            self.connect(connector)
 
         if self.send_images:
-            start_thread(
+            self.start_web_stream(self.camera.get_reader())
+
+        if self.record_video:
+            self.start_video_stream(self.camera.get_reader(), uploaders)
+
+        if self.motion is not None:
+            if self.event_recorder is not None:
+                recorder = self.event_recorder
+                self.motion.listeners.append(lambda score, motion: motion and recorder.trigger("motion"))
+            self.start_motion(self.camera.get_reader())
+
+    def connect(self, connector=None):
+        self.connector = connector or Connector.create(self.config['connection'])
+        self.connector.log_metrics = self.log_metrics
+
+    def start_web_stream(self, reader):
+        scheduler = FrameScheduler(reader, self.target_web_framerate)
+        self.register_stream_metrics('web', scheduler)
+        gate = None
+        if self.adaptive_config['enabled']:
+            self.adaptive = self.get_adaptive_controller(scheduler)
+            gate = self.adaptive.should_send
+            for key in ('rate', 'quality', 'scale'):
+                metrics.gauge('spypi_adaptive_{}'.format(key), "Adaptive web stream {}".format(key), ['camera']) \
+                    .labels(camera=self.name).set_function(lambda key=key: self.adaptive.get_state()[key])
+        return start_thread(
+            self.stream_process,
+            scheduler=scheduler,
+            transform=self.apply_stream_transforms,
+            handle=self.connector.send_image,
+            release=self.web_transform.release,
+            name="web",
+            gate=gate,
+        )
+
+    def start_video_stream(self, reader, uploaders=None):
+        self.video_stream = self.camera.vstream = VideoStream(
+            filename_prefix=self.config['connection']['name'],
+            directory=self.recording_directory,
+            max_file_size=self.video_filesize,
+            resolution=self.camera.frame_size,
+            fps=self.target_video_framerate,
+            log_metrics=self.log_metrics,
+            queue_size=self.video_queue,
+            encoder=self.video_encoder,
+            max_duration=self.video_duration,
+            align_keyframes=self.video_keyframe_split,
+        )
+
+        if self.send_video:
+            self.uploader = self.get_uploader({} if uploaders is None else uploaders)
+            self.video_stream.listeners.append(self.uploader.add)
+
+        handle = self.video_stream.add_frame
+        if self.record_mode == 'event':
+            if isinstance(self.camera, PiCamDirect):
+                self.logger.warning("Event recording is not supported by picam-direct - recording continuously")
+            else:
+                handle = self.start_event_recorder().add_frame
+
+        if not isinstance(self.camera, PiCamDirect):
+            scheduler = FrameScheduler(reader, self.target_video_framerate)
+            self.register_stream_metrics('video', scheduler)
+            return start_thread(
                 self.stream_process,
-                next=self.camera.next_image,
-                transform=self.apply_stream_transforms,
-                handle=self.connector.send_image,
-                name="web",
-                controller=self.get_pid(self.web_pid, self.target_web_framerate)
+                scheduler=scheduler,
+                transform=self.apply_video_transforms,
+                handle=handle,
+                release=self.video_transform.release,
+                name="video",
             )
 
+    def start_motion(self, reader):
+        metrics.gauge('spypi_motion_score', "Fraction of watched pixels that changed", ['camera']) \
+            .labels(camera=self.name).set_function(lambda: self.motion.score)
+        return start_thread(self.motion.run, next=reader.next, log_metrics=self.log_metrics,
+                            budget=self.cpu_budget, timer=STAGE_SECONDS.labels(camera=self.name, stage='motion'))
+
+    def register_camera_metrics(self):
+        # Read from the camera's own counters when scraped, so they cost nothing in between
+        labels = dict(camera=self.name)
+        metrics.gauge('spypi_camera_fps', "Capture rate", ['camera']) \
+            .labels(**labels).set_function(self.camera.image_counter.get_rate)
+        metrics.counter('spypi_camera_frames_total', "Frames captured", ['camera']) \
+            .labels(**labels).set_function(lambda: self.camera.frames)
+        metrics.counter('spypi_camera_dropped_total', "Frames dropped with every buffer slot in use", ['camera']) \
+            .labels(**labels).set_function(lambda: self.camera.images.dropped)
+        metrics.counter('spypi_camera_skipped_total', "Frames skipped to stay under max_fps", ['camera']) \
+            .labels(**labels).set_function(lambda: self.camera.skipped)
+        if self.record_video:
+            directory = self.recording_directory
+            metrics.gauge('spypi_disk_free_bytes', "Free space where recordings are written", ['directory']) \
+                .labels(directory=directory).set_function(lambda: shutil.disk_usage(directory).free)
+
+    def register_stream_metrics(self, name, scheduler):
+        labels = dict(camera=self.name, stage=name)
+        metrics.counter('spypi_stream_frames_total', "Frames handled by each stream", ['camera', 'stage']) \
+            .labels(**labels).set_function(lambda: self.processed[name].value)
+        metrics.counter('spypi_stream_skipped_ticks_total', "Ticks missed by a stream falling behind",
+                        ['camera', 'stage']).labels(**labels).set_function(lambda: scheduler.skipped)
+        metrics.gauge('spypi_stream_target_fps', "Rate each stream is paced to", ['camera', 'stage']) \
+            .labels(**labels).set_function(lambda: scheduler.rate)
+
+    def serve_metrics(self, offset=0):
+        if self.metrics_config['enabled']:
+            metrics.serve(self.metrics_config['port'] + offset)
+
+    def run_processes(self):
+        """
+        Multiprocess mode: capture and motion detection stay in this process while the web and video
+        streams each get a forked process of their own, so their Python work doesn't contend for one
+        GIL. Frames pass through shared memory; motion and camera label info through shared values.
+        """
+        context = multiprocessing.get_context('fork')
+        self.camera.images = SharedFrameBuffer(self.shared_slots, self.camera.frame_size, context=context)
+        self.shared_state = context.Array('c', self.STATE_SIZE, lock=False)
+        self.shared_motion = context.Value('d', 0.0, lock=False)
+        atexit.register(self.stop_processes)
+
+        # Readers are subscribed and processes forked before any thread is started here
+        targets = {}
+        if self.send_images:
+            targets['web'] = self.run_web_process
         if self.record_video:
+            targets['video'] = self.run_video_process
+        self.processes = {}
+        for name, target in targets.items():
+            reader = self.camera.get_reader()
+            self.processes[name] = context.Process(target=target, args=(reader,), name=name, daemon=True)
+        motion_reader = self.camera.get_reader() if self.motion is not None else None
+        for process in self.processes.values():
+            process.start()
+
+        if 'video' in self.processes and self.record_mode == 'event':
+            # Triggers are sent to this process - pass them on to the one recording
+            pid = self.processes['video'].pid
+            signal.signal(signal.SIGUSR1, lambda *args: os.kill(pid, signal.SIGUSR1))
 
-            if self.send_video:
-                start_thread(self.send_directory_video)
+        self.camera.start()
+        self.register_camera_metrics()
+        if self.motion is not None:
+            self.motion.listeners.append(self.publish_motion)
+            self.start_motion(motion_reader)
+        start_thread(self.publish_state)
+        for name, process in self.processes.items():
+            start_thread(self.watch_process, name=name, process=process)
 
-            self.video_stream = self.camera.vstream = VideoStream(
-                filename_prefix=self.config['connection']['name'],
+    def run_web_process(self, reader):
+        # Each process has its own metrics, served on the next ports up
+        self.serve_metrics(1)
+        self.follow_capture()
+        self.connect()
+        if self.motion is not None:
+            self.motion = SharedMotion(self.shared_motion)
+        self.start_web_stream(reader).join()
+
+    def run_video_process(self, reader):
+        self.serve_metrics(2)
+        self.follow_capture()
+        if self.send_video:
+            self.connect()
+        thread = self.start_video_stream(reader)
+        if self.motion is not None and self.event_recorder is not None:
+            start_thread(self.forward_motion, motion=SharedMotion(self.shared_motion))
+        thread.join()
+
+    def follow_capture(self):
+        # The camera only runs in the capture process - its rate and label info come from there
+        self.camera_fps = 0
+        start_thread(self.follow_state)
+
+    def publish_motion(self, score, motion):
+        if motion:
+            self.shared_motion.value = self.motion.last_motion
+
+    def forward_motion(self, motion):
+        last = motion.last_motion
+        while True:
+            time.sleep(0.1)
+            if motion.last_motion != last:
+                last = motion.last_motion
+                self.event_recorder.trigger("motion")
+
+    def publish_state(self):
+        # Camera info the stream processes label frames and log with, refreshed once a second
+        while True:
+            state = json.dumps({
+                'extra_info': self.camera.extra_info,
+                'fps': self.camera.image_counter.get_rate(2),
+            }).encode()
+            self.shared_state.value = state[:self.STATE_SIZE - 1]
+            time.sleep(1)
+
+    def follow_state(self):
+        while True:
+            time.sleep(1)
+            try:
+                state = json.loads(self.shared_state.value.decode())
+            except ValueError:
+                continue
+            self.camera.extra_info = state['extra_info']
+            self.camera_fps = state['fps']
+
+    def watch_process(self, name, process):
+        process.join()
+        if not self.stopping:
+            self.logger.error("{0} process exited with code {1}".format(name.capitalize(), process.exitcode))
+
+    def stop_processes(self):
+        if self.stopping:
+            return
+        self.stopping = True
+        self.camera.stop()
+        for process in self.processes.values():
+            process.terminate()
+            process.join()
+        self.camera.images.close()
+
+    def get_camera_fps(self):
+        if self.camera_fps is not None:
+            return self.camera_fps
+        return self.camera.image_counter.get_rate(2)
+
+    def get_uploader(self, uploaders):
+        extension = self.camera.codec if isinstance(self.camera, PiCamDirect) else self.video_stream.extension
+        key = (self.recording_directory, extension)
+        if key not in uploaders:
+            uploaders[key] = VideoUploader(
+                connector=self.connector,
                 directory=self.recording_directory,
-                max_file_size=self.video_filesize,
-                resolution=self.camera.frame_size,
-                fps=self.target_video_framerate,
+                extension=extension,
+                workers=self.upload_workers,
+                order=self.upload_order,
                 log_metrics=self.log_metrics,
             )
+            uploaders[key].start()
+        return uploaders[key]
+
+    def start_event_recorder(self):
+        self.event_recorder = EventRecorder(
+            video_stream=self.video_stream,
+            preroll=self.event_preroll,
+            postroll=self.event_postroll,
+            log_metrics=self.log_metrics,
+        )
+        self.event_recorder.listen_signal()
+        if self.event_port:
+            self.event_recorder.listen_http(self.event_port)
+        return self.event_recorder
 
-            if not isinstance(self.camera, PiCamDirect):
-                start_thread(
-                    self.stream_process,
-                    next=self.camera.next_image,
-                    transform=self.apply_video_transforms,
-                    handle=self.video_stream.add_frame,
-                    name="video",
-                    controller=self.get_pid(self.vid_pid, self.target_video_framerate)
-                )
-
-    def get_pid(self, params, target):
-        pid = PID(params[0], params[1], params[2], setpoint=target)
-        pid.output_limits = (params[3], params[4])
-        pid.interval = params[-1]
-        return pid
-
-    def stream_process(self, next, transform, handle, name, controller):
-        delay = 0
-        interval = controller.interval
-        fc = MultiCounter(interval)
-        fps_averages = deque(maxlen=interval)
+    def get_adaptive_controller(self, scheduler):
+        config = self.adaptive_config
+        adaptive = AdaptiveController(
+            connector=self.connector,
+            transform=self.web_transform,
+            motion=self.motion,
+            base_rate=self.target_web_framerate,
+            motion_rate=config['motion_framerate'],
+            keepalive_rate=config['keepalive_framerate'],
+            motion_hold=config['motion_hold'],
+            latency_target=config['latency_target'] * 1e-3,
+            min_quality=config['min_quality'],
+            quality_step=config['quality_step'],
+            min_scale=config['min_scale'],
+            log_metrics=self.log_metrics,
+        )
+        # Ticks keep coming at no less than the base rate so a change in motion is noticed promptly
+        adaptive.listeners.append(
+            lambda state: scheduler.set_rate(max(state['rate'], self.target_web_framerate)))
+        return adaptive
+
+    def stream_process(self, scheduler, transform, handle, release, name, gate=None):
+        """
+        :param release: hands a transformed frame back to the transform once 'handle' is done with it
+        """
+        fc = MultiCounter(10)
+        age = FRAME_AGE.labels(camera=self.name, stage=name)
+        timer = STAGE_SECONDS.labels(camera=self.name, stage=name)
         while True:
+            # Sleeps until the next tick, then blocks until the camera commits a frame for it
+            frame = scheduler.next(timeout=1)
+            if frame is None:
+                continue
             try:
-                img = next()
-                if img is None:
-                    continue
-                f = fc.get_rate(2)
-                fps_averages.append(f)
+                age.observe(time.time() - frame.timestamp)
+                fps = fc.get_rate(2)
                 if fc.increment():
-                    fps = round(sum(fps_averages) / interval, 2)
-                    delay = controller(fps)
-                    if self.log_metrics:
-                        self.logger.debug("{0} // framerate: {1} // sleeptime: {2}"
-                                          .format(name.capitalize(), fps, round(delay, 4)))
-                    cfps = self.camera.image_counter.get_rate(2)
-                    if name == 'video' and not self.ignore_warnings and fps >= cfps:
-                        self.logger.warning("Warning: stream-to-video fps ({0})> "
-                                            "acquisition rate ({1})! Please adjust PID"
-                                            .format(fps, cfps))
-                handle(transform(img, f))
-            except IndexError:
-                pass
+                    self.log_stream_metrics(name, scheduler, fps, frame)
+                if gate is None or gate():
+                    trace = self.tracer.start(self.name, name, frame) if self.tracer is not None else None
+                    self.process_frame(transform, handle, release, frame.image, fps, timer, trace)
+                    self.processed[name].value += 1
             finally:
-                time.sleep(delay)
+                frame.release()
+
+    def process_frame(self, transform, handle, release, image, fps, timer, trace=None):
+        start, cpu = time.perf_counter(), time.thread_time()
+        with self.workers:
+            handle(transform(image, fps, trace), trace, release)
+        timer.observe(time.perf_counter() - start)
+        # Sleeping off an overdrawn budget holds up the scheduler, which skips ticks until it recovers
+        self.cpu_budget.consume(time.thread_time() - cpu)
 
-    def apply_stream_transforms(self, image, fps=None):
-        image = im.crop(image, self.crop)
-        image = im.resize(image, self.image_size)
-        image = im.rotate(image, self.rotation, resize=False)
-        return self.apply_data_bar(image, fps, 'web')
+    def log_stream_metrics(self, name, scheduler, fps, frame):
+        if self.log_metrics:
+            self.logger.debug("{0} // framerate: {1} // target: {2} // lag: {3} ms // skipped ticks: {4}".format(
+                name.capitalize(), fps, scheduler.rate, round(1000 * (time.time() - frame.timestamp), 1),
+                scheduler.skipped))
+        cfps = self.get_camera_fps()
+        if name == 'video' and not self.ignore_warnings and cfps and scheduler.rate > cfps:
+            self.logger.warning("Warning: target video framerate ({0}) > acquisition rate ({1})! "
+                                "Recordings will play back too fast".format(scheduler.rate, cfps))
 
-    def apply_video_transforms(self, image, fps=None):
-        image = im.rotate(image, self.rotation)
-        return self.apply_data_bar(image, fps, 'video')
+    def apply_stream_transforms(self, image, fps=None, trace=None):
+        return self.apply_data_bar(self.web_transform(image), fps, 'web', trace)
 
-    def compute_data_bar_geom(self):
-        for name, size in self.data_scaling.items():
-            ((_, text_height), _) = cv2.getTextSize('XXX', cv2.FONT_HERSHEY_DUPLEX, size[0], 1)
-            self.data_scaling[name].append(text_height)
+    def apply_video_transforms(self, image, fps=None, trace=None):
+        return self.apply_data_bar(self.video_transform(image), fps, 'video', trace)
 
-    def apply_data_bar(self, image, fps, name):
+    def apply_data_bar(self, image, fps, name, trace=None):
+        if trace is not None:
+            trace.mark('transform')
 
-        h, w, _ = image.shape
         label = ["{0} @ {1:.2f} FPS".format(
             timestamp(), fps)] if self.show_fps else [timestamp()]
 
         if self.log_extra_info:
             label.extend(self.camera.extra_info)
 
-        text_scale = self.data_scaling[name][0]
-        text_padding = self.data_scaling[name][1]
-        text_height = self.data_scaling[name][2]
-        vspace = text_height * len(label) + (len(label) + 1) * text_padding
-
-        # Draw a box of proper height including between line padding
-        image = im.rectangle(image, [w, vspace], (0, 0, 0))
-
-        # Add labels
-        image = im.add_label(image, label, text_height, text_scale, (255, 255, 255), text_padding)
+        # Black box sized for the label lines, with the text blitted from cached sprites
+        image = self.data_bars[name].draw(image, label)
+        if trace is not None:
+            trace.mark('data_bar')
         return image
 
-    def send_directory_video(self):
-        pattern = join(self.recording_directory, "*.{}".format(self.camera.codec))
-        while True:
-            for file in glob.glob(pattern):
-                if file.split(os.sep)[-1].startswith("LOCKED"):
-                    continue
-                result = self.connector.send_video(file)
-                if result is True:
-                    os.unlink(file)
-            time.sleep(10)
-
 
 class ImageWriter():
     def __init__(self, config):
         self.logger = logging.getLogger("reader")
         self.processor = ImageProcessor(config)
+        # Frames are read on this thread with read_next_frame, which reuses the converter's buffers
+        self.processor.camera.read_thread = False
         self.processor.camera.start()
 
-    def write_images(self, number):
+    def write_images(self, number, raw=False):
+        if raw and not isinstance(self.processor.camera, ArduCam):
+            raise ValueError("Raw frames can only be written by arducam")
         i = 0
         while i < number:
             try:
+                if raw:
+                    frame = self.processor.camera.read_next_frame(raw=True)
+                    if frame is not None:
+                        filename = os.path.abspath("frame-{}.raw".format(i + 1))
+                        with open(filename, 'wb') as f:
+                            f.write(frame[0])
+                        self.logger.info("Wrote {}".format(filename))
+                        i += 1
+                    continue
                 image = self.processor.camera.read_next_frame()
                 if image is not None:
                     filename = os.path.abspath("frame-{}.jpg".format(i + 1))
-                    cv2.imwrite(filename, self.processor.apply_stream_transforms(image))
+                    image = self.processor.apply_stream_transforms(image)
+                    cv2.imwrite(filename, image)
+                    self.processor.web_transform.release(image)
                     self.logger.info("Wrote {}".format(filename))
                     i += 1
             except (ImageReadException, ArducamException) as e:
@@ -197,6 +510,8 @@ class ImagePlayer():
     def __init__(self, config):
         self.logger = logging.getLogger("reader")
         self.processor = ImageProcessor(config)
+        # Frames are read on this thread with read_next_frame, which reuses the converter's buffers
+        self.processor.camera.read_thread = False
         self.processor.camera.start()
 
     def run(self):
@@ -204,6 +519,8 @@ class ImagePlayer():
             try:
                 image = self.processor.camera.read_next_frame()
                 if image is not None:
-                    im.show(self.processor.apply_stream_transforms(image))
+                    image = self.processor.apply_stream_transforms(image)
+                    im.show(image)
+                    self.processor.web_transform.release(image)
             except (ImageReadException, ArducamException) as e:
                 self.logger.warning("Bad image read: {}".format(e))
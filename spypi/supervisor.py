@@ -0,0 +1,50 @@
+import logging
+import os
+import threading
+
+from spypi.config import get_device_configs
+from spypi.model import Connector
+from spypi.process import ImageProcessor
+
+
+class Supervisor():
+    """
+    Runs one ImageProcessor per entry in 'devices' in a single process. The cameras post through
+    one Connector (session, bandwidth limit and image workers), share an uploader per recording
+    directory, and take turns on a pool of 'workers' slots for their stream transforms. Each
+    camera's 'max_fps' and 'cpu_budget' keep it from starving the others.
+    """
+
+    def __init__(self, config):
+        self.logger = logging.getLogger("supervisor")
+        self.config = config
+        self.log_metrics = config['logging']['log_metrics']
+        workers = config['supervisor']['workers'] or os.cpu_count() or 1
+        self.workers = threading.BoundedSemaphore(workers)
+        self.connector = None
+        self.uploaders = {}
+        self.processors = {}
+        for device_config in get_device_configs(config):
+            name = device_config['connection']['name']
+            processor = ImageProcessor(device_config)
+            # Camera name first - the log format only has room for the start of a logger's name
+            processor.logger = logging.getLogger("{}.processor".format(name))
+            processor.camera.logger = logging.getLogger("{0}.{1}".format(name, processor.camera.camera_type))
+            processor.workers = self.workers
+            if processor.multiprocess:
+                # Forking once the other cameras' threads are running isn't safe
+                self.logger.warning("Multiprocess mode is not supported with several devices - {} runs threaded"
+                                    .format(name))
+                processor.multiprocess = False
+            self.processors[name] = processor
+        self.logger.info("Supervising {0} cameras with {1} workers: {2}"
+                         .format(len(self.processors), workers, ", ".join(self.processors)))
+
+    def run(self):
+        if any(p.send_images or p.send_video for p in self.processors.values()):
+            self.connector = Connector.create(self.config['connection'])
+            self.connector.log_metrics = self.log_metrics
+
+        for name, processor in self.processors.items():
+            connector = self.connector.camera(name) if self.connector is not None else None
+            processor.run(connector=connector, uploaders=self.uploaders)
@@ -0,0 +1,186 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from spypi.utils import DropQueue, start_thread
+
+
+class Trace():
+    """
+    Timings of one frame on its way through a stream. Each mark() records the milliseconds since
+    the previous one, starting from when the sensor was read, so the stages add up to the frame's
+    age when the last of them finished.
+    """
+
+    def __init__(self, tracer, camera, stream, frame):
+        self.tracer = tracer
+        self.captured = frame.captured
+        self.last = frame.captured
+        self.stages = OrderedDict()
+        self.record = {
+            'camera': camera,
+            'stream': stream,
+            'seq': frame.seq,
+            'captured': round(frame.captured, 6),
+            'stages': self.stages,
+        }
+        # Sensor read to committed in the buffer, then committed to taken by the stream
+        self.mark('convert', frame.timestamp)
+        self.mark('wait')
+
+    def mark(self, stage, now=None):
+        now = time.time() if now is None else now
+        self.stages[stage] = round(1000 * (now - self.last), 3)
+        self.last = now
+
+    def finish(self):
+        if self.tracer is not None:
+            self.record['total'] = round(1000 * (self.last - self.captured), 3)
+            self.tracer.write(self.record)
+            self.tracer = None
+
+
+class Tracer():
+    """
+    Follows every 'sample_every'th frame of each stream from the sensor to the end of the last stage
+    that handles it, and appends its timings to 'filename' as one JSON line:
+
+        {"camera": "cam", "stream": "web", "seq": 1200, "captured": 1600000000.1,
+         "stages": {"convert": 9.1, "wait": 1.2, "transform": 4.0, "data_bar": 0.4,
+                    "queue": 0.1, "encode": 6.2, "post": 21.5}, "total": 42.5}
+
+    Web frames end when their POST completes, video frames once they are written to the file.
+    Lines are written on a thread of their own and dropped if it falls behind. The file is moved
+    to 'filename.1' once it reaches 'max_size' MB.
+    """
+
+    def __init__(self, filename, sample_every=10, max_size=10):
+        self.logger = logging.getLogger("trace")
+        self.filename = filename
+        self.sample_every = sample_every
+        self.max_size = int(max_size * 1e6)
+        self.counts = {}
+        self.queue = DropQueue(256)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self, camera, stream, frame):
+        """
+        :return: Trace for the frame if it is sampled, otherwise None
+        """
+        key = (camera, stream)
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        if count % self.sample_every:
+            return None
+        return Trace(self, camera, stream, frame)
+
+    def write(self, record):
+        # Started on first use - in multiprocess mode that is after the stream processes are forked
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = start_thread(self.write_traces)
+        self.queue.put(record)
+
+    def write_traces(self):
+        file = None
+        while True:
+            record = self.queue.get(timeout=1)
+            if record is None:
+                continue
+            try:
+                if file is None:
+                    file = open(self.filename, 'a')
+                file.write(json.dumps(record) + "\n")
+                file.flush()
+                if file.tell() >= self.max_size:
+                    file.close()
+                    file = None
+                    self.rotate()
+            except OSError as e:
+                self.logger.error("Unable to write trace: {}".format(e))
+                file = None
+
+    def rotate(self):
+        try:
+            if os.stat(self.filename).st_size >= self.max_size:
+                os.replace(self.filename, self.filename + ".1")
+        except FileNotFoundError:
+            # Another process writing to the same file got there first
+            pass
+
+
+TRACERS = {}
+TRACERS_LOCK = threading.Lock()
+
+
+def get_tracer(config):
+    """
+    :param config: the 'trace' section of a config
+    :return: Tracer for the configured file, shared by every camera writing to it, or None if disabled
+    """
+    if not config['enabled']:
+        return None
+    with TRACERS_LOCK:
+        tracer = TRACERS.get(config['filename'])
+        if tracer is None:
+            tracer = TRACERS[config['filename']] = Tracer(
+                config['filename'], sample_every=config['sample_every'], max_size=config['max_size'])
+        return tracer
+
+
+def load_traces(filenames):
+    traces = []
+    for filename in filenames:
+        with open(filename) as f:
+            for line in f:
+                try:
+                    traces.append(json.loads(line))
+                except ValueError:
+                    # A line cut short when the process was killed
+                    pass
+    return traces
+
+
+def percentile(values, p):
+    # Nearest rank, on sorted values
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(traces, percentiles=(50, 95, 99)):
+    """
+    :return: {(camera, stream): {stage: {'count': n, 'p50': ms, ...}}} with 'total' as the last stage
+    """
+    stages = OrderedDict()
+    for trace in sorted(traces, key=lambda t: (t['camera'], t['stream'])):
+        times = stages.setdefault((trace['camera'], trace['stream']), OrderedDict())
+        for stage, ms in list(trace['stages'].items()) + [('total', trace['total'])]:
+            times.setdefault(stage, []).append(ms)
+
+    summary = OrderedDict()
+    for key, times in stages.items():
+        summary[key] = OrderedDict()
+        for stage, values in times.items():
+            values.sort()
+            result = summary[key][stage] = {'count': len(values)}
+            for p in percentiles:
+                result['p{}'.format(p)] = percentile(values, p)
+    return summary
+
+
+def format_report(summary, percentiles=(50, 95, 99)):
+    columns = ['p{}'.format(p) for p in percentiles]
+    lines = []
+    for (camera, stream), stages in summary.items():
+        lines.append("{0} / {1} ({2} frames, ms)".format(camera, stream, stages['total']['count']))
+        lines.append("  {0:<10}{1:>8}".format("stage", "count") + "".join("{:>10}".format(c) for c in columns))
+        for stage, result in stages.items():
+            lines.append("  {0:<10}{1:>8}".format(stage, result['count']) +
+                         "".join("{:>10.1f}".format(result[c]) for c in columns))
+        lines.append("")
+    return "\n".join(lines)
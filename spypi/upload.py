@@ -0,0 +1,203 @@
+import ctypes
+import ctypes.util
+import glob
+import logging
+import os
+import platform
+import struct
+import threading
+import time
+from collections import deque
+from os.path import join
+
+from spypi import metrics
+from spypi.utils import start_thread
+
+UPLOADS = metrics.counter('spypi_uploads_total', "Video upload attempts", ['directory', 'result'])
+
+
+class InotifyWatcher():
+    """
+    Reports files renamed into a directory, using inotify through libc (Linux only)
+    """
+
+    IN_MOVED_TO = 0x00000080
+    IN_Q_OVERFLOW = 0x00004000
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, directory, callback, overflow=None):
+        self.directory = directory
+        self.callback = callback
+        self.overflow = overflow
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), self.IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch failed for {}".format(directory))
+
+    @staticmethod
+    def available():
+        return platform.system() == 'Linux'
+
+    def run(self):
+        while True:
+            data = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & self.IN_Q_OVERFLOW and self.overflow:
+                    self.overflow()
+                elif mask & self.IN_MOVED_TO and name:
+                    self.callback(join(self.directory, os.fsdecode(name)))
+
+
+class VideoUploader():
+    """
+    Uploads finished recordings on 'workers' threads, oldest or newest first. Failed files
+    stay queued and are retried after 'interval' seconds. Bandwidth is capped by the connector.
+
+    Files are picked up when VideoStream.finish_file reports them in-process, or through inotify
+    when another process renames them into the directory. The directory is only globbed once at
+    startup to recover anything left over from the last run.
+    """
+
+    def __init__(self, connector, directory, extension, workers=1, order='oldest', interval=10, log_metrics=False):
+        self.logger = logging.getLogger("uploader")
+        self.connector = connector
+        self.directory = directory
+        self.extension = extension
+        self.workers = workers
+        self.newest_first = order == 'newest'
+        self.interval = interval
+        self.log_metrics = log_metrics
+        self.pending = {}
+        self.active = set()
+        self.retry_at = {}
+        self.completed = deque(maxlen=20)
+        self.ready = threading.Condition()
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.start_watcher()
+        self.scan_directory()
+        for _ in range(self.workers):
+            start_thread(self.worker)
+        self.register_metrics()
+        if self.log_metrics:
+            start_thread(self.log_metrics_loop)
+
+    def start_watcher(self):
+        if not InotifyWatcher.available():
+            self.logger.info("inotify unavailable - only picking up videos recorded by this process")
+            return
+        try:
+            watcher = InotifyWatcher(self.directory, self.add, overflow=self.scan_directory)
+        except (OSError, AttributeError) as e:
+            self.logger.warning("Could not watch {0}: {1}".format(self.directory, e))
+            return
+        start_thread(watcher.run)
+
+    def scan_directory(self):
+        for file in glob.glob(join(self.directory, "*.{}".format(self.extension))):
+            self.add(file)
+
+    def register_metrics(self):
+        labels = dict(directory=self.directory)
+        metrics.gauge('spypi_upload_backlog_files', "Recordings waiting to be uploaded", ['directory']) \
+            .labels(**labels).set_function(lambda: len(self.pending))
+        metrics.gauge('spypi_upload_backlog_bytes', "Bytes waiting to be uploaded", ['directory']) \
+            .labels(**labels).set_function(lambda: self.get_backlog()['bytes'])
+        metrics.gauge('spypi_upload_throughput_bytes', "Recent upload rate in bytes per second", ['directory']) \
+            .labels(**labels).set_function(self.get_throughput)
+
+    def log_metrics_loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.log_backlog()
+
+    def is_finished(self, path):
+        name = os.path.basename(path)
+        return name.endswith(".{}".format(self.extension)) and not name.startswith("LOCKED")
+
+    def add(self, path):
+        if not self.is_finished(path):
+            return
+        with self.ready:
+            if path in self.pending:
+                return
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return
+            self.pending[path] = (stat.st_mtime, stat.st_size)
+            self.ready.notify()
+
+    def next_file(self):
+        now = time.time()
+        candidates = [p for p in self.pending if p not in self.active and self.retry_at.get(p, 0) <= now]
+        if not candidates:
+            return None
+        pick = max if self.newest_first else min
+        return pick(candidates, key=lambda p: self.pending[p][0])
+
+    def worker(self):
+        while True:
+            with self.ready:
+                path = self.next_file()
+                while path is None:
+                    self.ready.wait(timeout=self.interval)
+                    path = self.next_file()
+                self.active.add(path)
+                size = self.pending[path][1]
+
+            start = time.perf_counter()
+            result = self.connector.send_video(path)
+            elapsed = time.perf_counter() - start
+            if result is True:
+                # Outside the lock, and still active so no other worker picks the file up meanwhile
+                try:
+                    os.unlink(path)
+                except OSError as e:
+                    self.logger.warning("Uploaded {0} but could not delete it: {1}".format(path, e))
+
+            with self.ready:
+                self.active.discard(path)
+                UPLOADS.labels(directory=self.directory, result='ok' if result is True else 'failed').inc()
+                if result is True:
+                    self.pending.pop(path, None)
+                    self.retry_at.pop(path, None)
+                    self.completed.append((size, elapsed))
+                else:
+                    self.retry_at[path] = time.time() + self.interval
+                self.ready.notify()
+
+    def get_throughput(self):
+        # Bytes per second per worker over the recent uploads, scaled by the workers running in parallel
+        done = list(self.completed)
+        elapsed = sum(e for _, e in done)
+        return self.workers * sum(s for s, _ in done) / elapsed if elapsed else 0
+
+    def get_backlog(self):
+        with self.ready:
+            files = len(self.pending)
+            size = sum(s for _, s in self.pending.values())
+        rate = self.get_throughput()
+        return {
+            'files': files,
+            'bytes': size,
+            'throughput': rate,
+            'eta': size / rate if rate else None,
+        }
+
+    def log_backlog(self):
+        backlog = self.get_backlog()
+        if backlog['files']:
+            self.logger.debug("Upload backlog: {0} files // {1} MB // {2} MB/s // ETA: {3}".format(
+                backlog['files'], round(backlog['bytes'] * 1e-6, 2), round(backlog['throughput'] * 1e-6, 3),
+                "{} s".format(round(backlog['eta'])) if backlog['eta'] is not None else "unknown"))
@@ -1,4 +1,6 @@
+import hashlib
 import logging.config
+import os
 import platform
 import socket
 import sys
@@ -22,6 +24,14 @@ def ddrate(hz, measuerments):
     return round(hz * 3600 * 24 * 0.001 * sum(measuerments) / len(measuerments), 8)
 
 
+def file_checksum(path, block_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
 def is_windows():
     return platform.system().lower() == "windows"
 
@@ -94,7 +104,9 @@ def init_logger(config):
 
 
 def start_thread(process_handle, **kwargs):
-    threading.Thread(target=process_handle, args=kwargs.values()).start()
+    thread = threading.Thread(target=process_handle, args=kwargs.values())
+    thread.start()
+    return thread
 
 
 class MultiCounter():
@@ -114,5 +126,139 @@ class MultiCounter():
     def get_rate(self, rnd=None):
         if len(self.times) < 2:
             return 0
-        rate = len(self.times) / (self.times[-1] - self.times[0])
+        # n timestamps span n - 1 intervals
+        rate = (len(self.times) - 1) / (self.times[-1] - self.times[0])
         return round(rate, rnd) if rnd else rate
+
+
+class DropQueue():
+    """
+    Bounded FIFO for handing work to other threads which discards the oldest item
+    rather than blocking the producer when full
+    """
+
+    def __init__(self, size=2):
+        self.items = deque(maxlen=size)
+        self.ready = threading.Condition()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        """
+        :return: the oldest item if it was dropped to make room, otherwise None
+        """
+        dropped = None
+        with self.ready:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1
+                dropped = self.items.popleft()
+            self.items.append(item)
+            self.ready.notify()
+        return dropped
+
+    def get(self, timeout=None):
+        with self.ready:
+            if not self.ready.wait_for(lambda: self.items, timeout):
+                return None
+            return self.items.popleft()
+
+
+class TokenBucket():
+    """
+    Shared rate limit in units per second. consume() takes what it needs up front and sleeps off
+    any debt, so callers are paced to 'rate' on average with bursts of up to 'burst'.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.perf_counter()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - amount
+            self.updated = now
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class PacedBody():
+    """
+    Request body read block by block as it is sent, with each block charged to a TokenBucket, so an
+    upload goes out at the bucket's rate instead of at line speed after one long pause. Made up of
+    byte strings and open binary files sent in order. Seekable, so a retried request can rewind it.
+    """
+
+    def __init__(self, bucket, *parts):
+        self.bucket = bucket
+        self.parts = []
+        offset = 0
+        for part in parts:
+            size = len(part) if isinstance(part, bytes) else os.fstat(part.fileno()).st_size
+            self.parts.append((offset, size, part))
+            offset += size
+        self.length = offset
+        self.position = 0
+
+    def __len__(self):
+        return self.length
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        self.position = {0: 0, 1: self.position, 2: self.length}[whence] + offset
+        return self.position
+
+    def read(self, size=-1):
+        end = self.length if size is None or size < 0 else min(self.length, self.position + size)
+        blocks = []
+        for offset, length, part in self.parts:
+            if self.position >= end:
+                break
+            if self.position >= offset + length:
+                continue
+            start, stop = self.position - offset, min(end, offset + length) - offset
+            if isinstance(part, bytes):
+                block = part[start:stop]
+            else:
+                part.seek(start)
+                block = part.read(stop - start)
+            blocks.append(block)
+            self.position += len(block)
+            if len(block) < stop - start:
+                # File shrank since the body was made - the request will fail on its length
+                break
+        data = b''.join(blocks)
+        self.bucket.consume(len(data))
+        return data
+
+
+class CountingFile():
+    """
+    Binary file that counts the bytes written to it, so its size is known without stat calls
+    """
+
+    def __init__(self, path, mode='wb'):
+        self.name = path
+        self.file = open(path, mode)
+        self.bytes_written = 0
+
+    def write(self, data):
+        written = self.file.write(data)
+        self.bytes_written += written
+        return written
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
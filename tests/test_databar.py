@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from spypi.model import DataBar, ImageManip as im
+
+LABEL = ["2020-12-01 10:00:01 @ 6.00 FPS", "Time: 1234 ISO: 56"]
+
+
+@pytest.mark.parametrize('channels', [3, 1])
+def test_draw_matches_put_text(channels):
+    bar = DataBar(0.8, 10)
+    image = np.full((480, 640, channels), 40, dtype=np.uint8)
+    expected = im.add_label(im.rectangle(image.copy(), [640, bar.get_height(len(LABEL))]),
+                            LABEL, bar.text_height, bar.scale, bar.color, bar.padding)
+
+    result = bar.draw(image, LABEL)
+
+    assert result.shape == expected.shape
+    assert np.abs(result.astype(int) - expected.astype(int)).mean() < 0.5
+
+
+def test_draw_grayscale_after_color():
+    # Sprites cached for one channel layout must not be reused for another
+    bar = DataBar(0.8, 10)
+    bar.draw(np.zeros((480, 640, 3), dtype=np.uint8), LABEL)
+    image = bar.draw(np.full((480, 640), 40, dtype=np.uint8), LABEL)
+    assert image.shape == (480, 640)
+    assert image.max() > 200
+    assert image[0, 0] == 40
@@ -0,0 +1,15 @@
+import numpy as np
+import pytest
+
+from spypi.motion import MotionDetector
+
+
+@pytest.mark.parametrize('shape', [(480, 640, 3), (480, 640, 1), (480, 640)])
+def test_scores_moving_square(shape):
+    detector = MotionDetector(roi=[10, 10, 10, 10])
+    image = np.zeros(shape, dtype=np.uint8)
+    assert detector.update(image) == 0.0
+    assert detector.update(image) == 0.0
+
+    image[200:300, 200:300] = 255
+    assert detector.update(image) > 0.01
@@ -0,0 +1,29 @@
+import time
+
+from spypi.buffer import Frame, FrameScheduler
+
+
+class ListReader():
+
+    def __init__(self, frames):
+        self.frames = list(frames)
+
+    def next(self, timeout=1):
+        return self.frames.pop(0) if self.frames else None
+
+
+def test_paces_by_capture_time():
+    # Captured on an 8 fps grid in the past, every other frame committed 150 ms late
+    start = float(int(time.time()) - 100)
+    frames = [Frame(None, 0, 0, i, start + i / 8 + 0.15 * (i % 2), None, start + i / 8)
+              for i in range(20)]
+    scheduler = FrameScheduler(ListReader(frames), 4)
+
+    seqs = []
+    frame = scheduler.next()
+    while frame is not None:
+        seqs.append(frame.seq)
+        frame = scheduler.next()
+
+    assert seqs == list(range(0, 20, 2))
+    assert scheduler.skipped == 0
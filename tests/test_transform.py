@@ -0,0 +1,25 @@
+import numpy as np
+
+from spypi.model import TransformPipeline
+
+
+def test_leased_output_is_not_reused():
+    pipeline = TransformPipeline(size=[64, 48], buffers=2)
+    image = np.zeros((96, 128, 3), dtype=np.uint8)
+    first = pipeline(image)
+    view = first[:10]
+    second = pipeline(image)
+    third = pipeline(image)
+    assert first is not second and first is not third and second is not third
+    assert view.base is first
+
+    pipeline.release(second)
+    assert pipeline(image) is second
+
+
+def test_release_after_rebuild_is_ignored():
+    pipeline = TransformPipeline(size=[64, 48])
+    old = pipeline(np.zeros((96, 128, 3), dtype=np.uint8))
+    new = pipeline(np.zeros((100, 128, 3), dtype=np.uint8))
+    pipeline.release(old)
+    assert pipeline(np.zeros((100, 128, 3), dtype=np.uint8)) is not new
@@ -0,0 +1,38 @@
+import numpy as np
+
+from spypi.encoder import VideoWriter
+from spypi.model import VideoStream
+
+
+class FailingWriter(VideoWriter):
+    # Fails on the second frame of the first file with an error the backends don't wrap
+
+    writers = []
+
+    def __init__(self, filename, resolution, fps, settings):
+        super(FailingWriter, self).__init__(filename, resolution, fps, settings)
+        self.output_bytes = 0
+        self.writers.append(self)
+        open(filename, 'wb').close()
+
+    def encode(self, frame):
+        if self is self.writers[0] and self.frames == 1:
+            raise OSError("disk went away")
+        self.output_bytes += 100
+        self.output_frames += 1
+
+    def release(self):
+        pass
+
+
+def test_writer_error_continues_in_new_file(tmpdir, monkeypatch):
+    monkeypatch.setattr(FailingWriter, 'writers', [])
+    stream = VideoStream('cam', directory=str(tmpdir), resolution=[64, 48], fps=10, encoder={'backend': 'opencv'})
+    stream.writer_class = FailingWriter
+    released = []
+    for _ in range(4):
+        stream.add_frame(np.zeros((48, 64, 3), dtype=np.uint8), release=released.append)
+    stream.stop()
+
+    assert len(released) == 4
+    assert [w.frames for w in FailingWriter.writers] == [1, 2]